@@ -1,11 +1,16 @@
-from typing import Optional, Union, Tuple, List, Callable, Dict
+from typing import Optional, Union, Tuple, List, Callable, Dict, NamedTuple
 from tqdm.notebook import tqdm
 import torch
 from diffusers import StableDiffusionPipeline, DDIMScheduler
 import torch.nn.functional as nnf
 import numpy as np
 import abc
+import copy
+import functools
+import time
+import json
 import ptp_utils
+import io_utils
 import seq_aligner
 import shutil
 from torch.optim.adam import Adam
@@ -36,6 +41,67 @@ def load_512(image_path, left=0, right=0, top=0, bottom=0):
     return image
 
 
+class ConvergencePolicy:
+    # when null_optimization stops optimising an image at a timestep. the defaults are the original rule: up to
+    # num_inner_steps iterations, an image is done once its loss is below epsilon + i * epsilon_slope.
+    # steps_per_timestep overrides num_inner_steps per timestep. time_budget (seconds for the whole
+    # optimisation) splits the time left evenly over the timesteps left. with plateau_tolerance an image is also
+    # done after plateau_patience iterations without improving its best loss by that fraction.
+    # convergence is tracked on the device and read back one iteration late, without a host sync: an image
+    # runs at most one extra forward and backward pass once done, its update is skipped so the result does
+    # not change
+
+    def inner_steps(self, i: int) -> int:
+        if self.steps_per_timestep is not None:
+            return self.steps_per_timestep[i]
+        return self.num_inner_steps
+
+    def threshold(self, i: int) -> float:
+        return self.epsilon + i * self.epsilon_slope
+
+    def deadline(self, i: int, start: float, num_timesteps: int) -> Optional[float]:
+        if self.time_budget is None:
+            return None
+        now = time.perf_counter()
+        return now + (start + self.time_budget - now) / (num_timesteps - i)
+
+    def first_steps(self, num_steps: int, num_timesteps: int) -> "ConvergencePolicy":
+        # the same policy, optimising only the first num_steps timesteps
+        policy = copy.copy(self)
+        policy.steps_per_timestep = [self.inner_steps(i) if i < num_steps else 0 for i in range(num_timesteps)]
+        return policy
+
+    def key(self) -> list:
+        # what the result depends on, for the inversion cache
+        return [self.num_inner_steps, self.epsilon, self.epsilon_slope, self.steps_per_timestep, self.time_budget,
+                self.plateau_tolerance, self.plateau_patience]
+
+    def __init__(self, num_inner_steps: int = 10, epsilon: float = 1e-5, epsilon_slope: float = 2e-5,
+                 steps_per_timestep: Optional[List[int]] = None, time_budget: Optional[float] = None,
+                 plateau_tolerance: Optional[float] = None, plateau_patience: int = 3):
+        self.num_inner_steps = num_inner_steps
+        self.epsilon = epsilon
+        self.epsilon_slope = epsilon_slope
+        self.steps_per_timestep = None if steps_per_timestep is None else list(steps_per_timestep)
+        self.time_budget = time_budget
+        self.plateau_tolerance = plateau_tolerance
+        self.plateau_patience = plateau_patience
+
+
+class InversionReport(NamedTuple):
+    # per timestep of the null-text optimisation of one image
+    timesteps: List[int]
+    iterations: List[int]
+    losses: List[float]  # of the last iteration run for the image
+    seconds: float  # of the whole batch the image was inverted in
+
+    def summary(self) -> str:
+        lines = [f"{len(self.timesteps)} timesteps, {sum(self.iterations)} iterations, {self.seconds:.1f}s"]
+        for t, iterations, loss in zip(self.timesteps, self.iterations, self.losses):
+            lines.append(f"t={t:4d} iterations={iterations:3d} loss={loss:.3e}")
+        return "\n".join(lines)
+
+
 class NullInversion:
 
     def prev_step(self, model_output: Union[torch.FloatTensor, np.ndarray], timestep: int,
@@ -85,8 +151,9 @@ class NullInversion:
         latents = 1 / 0.18215 * latents.detach()
         image = self.model.vae.decode(latents)['sample']
         if return_type == 'np':
+            # one uint8 image per latent, (N, H, W, 3)
             image = (image / 2 + 0.5).clamp(0, 1)
-            image = image.cpu().permute(0, 2, 3, 1).numpy()[0]
+            image = image.cpu().permute(0, 2, 3, 1).numpy()
             image = (image * 255).astype(np.uint8)
         return image
 
@@ -98,29 +165,27 @@ class NullInversion:
             if type(image) is torch.Tensor and image.dim() == 4:
                 latents = image
             else:
+                # a single (H, W, 3) image or a stack of them
                 image = torch.from_numpy(image).float() / 127.5 - 1
-                image = image.permute(2, 0, 1).unsqueeze(0).to(device)
+                if image.dim() == 3:
+                    image = image.unsqueeze(0)
+                image = image.permute(0, 3, 1, 2).to(device)
                 latents = self.model.vae.encode(image)['latent_dist'].mean
                 latents = latents * 0.18215
         return latents
 
     @torch.no_grad()
     def init_prompt(self, prompt: str):
-        uncond_input = self.model.tokenizer(
-            [""], padding="max_length", max_length=self.model.tokenizer.model_max_length,
-            return_tensors="pt"
-        )
-        uncond_embeddings = self.model.text_encoder(uncond_input.input_ids.to(self.model.device))[0]
-        text_input = self.model.tokenizer(
-            [prompt],
-            padding="max_length",
-            max_length=self.model.tokenizer.model_max_length,
-            truncation=True,
-            return_tensors="pt",
-        )
-        text_embeddings = self.model.text_encoder(text_input.input_ids.to(self.model.device))[0]
+        self.init_prompts([prompt])
+
+    @torch.no_grad()
+    def init_prompts(self, prompts: List[str]):
+        # one prompt per image inverted together
+        uncond_embeddings = ptp_utils.embedding_cache.get_uncond(self.model, len(prompts))
+        text_embeddings = ptp_utils.embedding_cache.get(self.model, prompts)
         self.context = torch.cat([uncond_embeddings, text_embeddings])
-        self.prompt = prompt
+        self.prompts = prompts
+        self.prompt = prompts[0]
 
     @torch.no_grad()
     def ddim_loop(self, latent):
@@ -145,76 +210,319 @@ class NullInversion:
         ddim_latents = self.ddim_loop(latent)
         return image_rec, ddim_latents
 
-    def null_optimization(self, latents, num_inner_steps, epsilon):
+    def null_optimization(self, latents, num_inner_steps, epsilon, policy: Optional[ConvergencePolicy] = None,
+                          init_embeddings=None):
+        # optimizes the null text embedding of every image in the batch at once. each image has its own
+        # embedding and Adam state, and drops out of the UNet batch once the policy has it converged, so the
+        # remaining ones continue as if they were inverted alone. every timestep starts from the result of the
+        # previous one, or from init_embeddings[i] (1, 77, d) when given. returns one (N, 77, d) tensor per
+        # step, the per image InversionReports are left in self.last_reports
+        if policy is None:
+            policy = ConvergencePolicy(num_inner_steps, epsilon)
+        unet = self.model.unet
+        # only the embedding is optimised, no gradients for the UNet weights
+        requires_grad = [param.requires_grad for param in unet.parameters()]
+        unet.requires_grad_(False)
+        try:
+            return self.optimize_null_embeddings(latents, policy, init_embeddings)
+        finally:
+            for param, param_requires_grad in zip(unet.parameters(), requires_grad):
+                param.requires_grad_(param_requires_grad)
+
+    def optimize_null_embeddings(self, latents, policy: ConvergencePolicy, init_embeddings=None):
+        start = time.perf_counter()
         uncond_embeddings, cond_embeddings = self.context.chunk(2)
+        batch_size = cond_embeddings.shape[0]
         uncond_embeddings_list = []
+        iterations_list, losses_list = [], []
         latent_cur = latents[-1]
-        bar = tqdm(total=num_inner_steps * NUM_DDIM_STEPS)
+        bar = tqdm(total=sum(policy.inner_steps(i) for i in range(NUM_DDIM_STEPS)))
         for i in range(NUM_DDIM_STEPS):
-            uncond_embeddings = uncond_embeddings.clone().detach()
-            uncond_embeddings.requires_grad = True
-            optimizer = Adam([uncond_embeddings], lr=1e-2 * (1. - i / 100.))
+            if init_embeddings is not None:
+                uncond_embeddings = init_embeddings[i].expand(batch_size, *init_embeddings[i].shape[1:])
+            if all(policy.inner_steps(n) == 0 for n in range(i, NUM_DDIM_STEPS)):
+                # nothing left to optimise, no need to step the latent either
+                for n in range(i, NUM_DDIM_STEPS):
+                    if init_embeddings is not None:
+                        uncond_embeddings = init_embeddings[n].expand(batch_size, *init_embeddings[n].shape[1:])
+                    uncond_embeddings_list.append(uncond_embeddings.detach())
+                    iterations_list.append(torch.zeros(batch_size, dtype=torch.long, device=latent_cur.device))
+                    losses_list.append(torch.full((batch_size,), float("nan"), device=latent_cur.device))
+                break
+            # separate leaves, a converged image keeps a None grad and Adam skips it
+            uncond_embeddings = [uncond_embeddings[k: k + 1].clone().detach().requires_grad_(True)
+                                 for k in range(batch_size)]
+            optimizer = Adam(uncond_embeddings, lr=1e-2 * (1. - i / 100.))
             latent_prev = latents[len(latents) - i - 2]
             t = self.model.scheduler.timesteps[i]
-            with torch.no_grad():
-                noise_pred_cond = self.get_noise_pred_single(latent_cur, t, cond_embeddings)
+            num_inner_steps, threshold = policy.inner_steps(i), policy.threshold(i)
+            if num_inner_steps > 0:
+                with torch.no_grad():
+                    noise_pred_cond = self.get_noise_pred_single(latent_cur, t, cond_embeddings)
+            deadline = policy.deadline(i, start, NUM_DDIM_STEPS)
+            # convergence state on the device. done is copied into the host flags after every iteration and
+            # read on the next one once its backward is queued, the device never waits for the host
+            done = torch.zeros(batch_size, dtype=torch.bool, device=latent_cur.device)
+            flags = torch.zeros(batch_size, dtype=torch.bool, pin_memory=latent_cur.is_cuda)
+            flags_ready = torch.cuda.Event() if latent_cur.is_cuda else None
+            flags_pending = False
+            iterations = torch.zeros(batch_size, dtype=torch.long, device=latent_cur.device)
+            losses = torch.full((batch_size,), float("nan"), device=latent_cur.device)
+            best_losses = torch.full((batch_size,), float("inf"), device=latent_cur.device)
+            stalls = torch.zeros(batch_size, dtype=torch.long, device=latent_cur.device)
+            active = list(range(batch_size))
+            rows = torch.arange(batch_size, device=latent_cur.device)
+            j = -1
             for j in range(num_inner_steps):
-                noise_pred_uncond = self.get_noise_pred_single(latent_cur, t, uncond_embeddings)
-                noise_pred = noise_pred_uncond + GUIDANCE_SCALE * (noise_pred_cond - noise_pred_uncond)
-                latents_prev_rec = self.prev_step(noise_pred, t, latent_cur)
-                loss = nnf.mse_loss(latents_prev_rec, latent_prev)
-                optimizer.zero_grad()
-                loss.backward()
+                if len(active) < batch_size:
+                    latent_active, noise_pred_cond_active, latent_prev_active = (
+                        latent_cur[rows], noise_pred_cond[rows], latent_prev[rows])
+                else:
+                    latent_active, noise_pred_cond_active, latent_prev_active = latent_cur, noise_pred_cond, latent_prev
+                uncond_active = torch.cat([uncond_embeddings[k] for k in active])
+                noise_pred_uncond = self.get_noise_pred_single(latent_active, t, uncond_active)
+                noise_pred = noise_pred_uncond + GUIDANCE_SCALE * (noise_pred_cond_active - noise_pred_uncond)
+                latents_prev_rec = self.prev_step(noise_pred, t, latent_active)
+                # summed per image losses, every image gets the gradient of its own mse
+                loss = nnf.mse_loss(latents_prev_rec, latent_prev_active, reduction='none').mean((1, 2, 3))
+                optimizer.zero_grad(set_to_none=True)
+                loss.sum().backward()
+                remaining = active
+                if flags_pending:
+                    if flags_ready is not None:
+                        flags_ready.synchronize()
+                    done_items = flags.tolist()
+                    # images done on the previous iteration keep a None grad, Adam leaves them as they are
+                    for k in active:
+                        if done_items[k]:
+                            uncond_embeddings[k].grad = None
+                    remaining = [k for k in active if not done_items[k]]
                 optimizer.step()
-                loss_item = loss.item()
+                running = ~done[rows]
+                loss = loss.detach()
+                iterations[rows] += running
+                losses[rows] = torch.where(running, loss, losses[rows])
+                converged = loss < threshold
+                if policy.plateau_tolerance is not None:
+                    improved = loss < best_losses[rows] * (1 - policy.plateau_tolerance)
+                    stalls[rows] = torch.where(improved, 0, stalls[rows] + 1)
+                    best_losses[rows] = torch.minimum(best_losses[rows], loss)
+                    converged |= stalls[rows] >= policy.plateau_patience
+                done[rows] |= converged
                 bar.update()
-                if loss_item < epsilon + i * 2e-5:
+                if not remaining or (deadline is not None and time.perf_counter() > deadline):
                     break
+                flags.copy_(done, non_blocking=True)
+                if flags_ready is not None:
+                    flags_ready.record()
+                flags_pending = True
+                if len(remaining) < len(active):
+                    # through pinned memory, a pageable copy would wait for the device
+                    rows = torch.tensor(remaining, pin_memory=latent_cur.is_cuda).to(latent_cur.device,
+                                                                                     non_blocking=True)
+                active = remaining
             for j in range(j + 1, num_inner_steps):
                 bar.update()
-            uncond_embeddings_list.append(uncond_embeddings[:1].detach())
+            iterations_list.append(iterations)
+            losses_list.append(losses)
+            uncond_embeddings = torch.cat(uncond_embeddings).detach()
+            uncond_embeddings_list.append(uncond_embeddings)
             with torch.no_grad():
                 context = torch.cat([uncond_embeddings, cond_embeddings])
                 latent_cur = self.get_noise_pred(latent_cur, t, False, context)
         bar.close()
+        timesteps = [int(t) for t in self.model.scheduler.timesteps[:NUM_DDIM_STEPS]]
+        iterations_list, losses_list = torch.stack(iterations_list, 1).tolist(), torch.stack(losses_list, 1).tolist()
+        seconds = time.perf_counter() - start
+        self.last_reports = [InversionReport(timesteps, iterations_list[k], losses_list[k], seconds)
+                             for k in range(batch_size)]
         return uncond_embeddings_list
 
-    def invert(self, image_path: str, prompt: str, offsets=(0, 0, 0, 0), num_inner_steps=10, early_stop_epsilon=1e-5,
-               verbose=False):
-        self.init_prompt(prompt)
+    def cache_key(self, image_gt: np.ndarray, offsets, prompt: str, policy: ConvergencePolicy) -> str:
+        model_key = ptp_utils.EmbeddingCache.model_key(self.model)
+        return io_utils.InversionCache.key(image_gt, list(offsets), prompt, model_key, NUM_DDIM_STEPS, GUIDANCE_SCALE,
+                                           *policy.key())
+
+    def cache_group(self) -> str:
+        # the inversions whose null embeddings are comparable, for the warm start of invert_fast
+        return json.dumps([ptp_utils.EmbeddingCache.model_key(self.model), NUM_DDIM_STEPS, GUIDANCE_SCALE])
+
+    def load_cached(self, key: str, image_gt: np.ndarray):
+        entry = self.cache.load(key)
+        if entry is None:
+            return None
+        x_t, uncond_embeddings, image_rec = entry
+        uncond_embeddings = torch.from_numpy(uncond_embeddings).to(device, self.model.text_encoder.dtype)
+        return (image_gt, image_rec), torch.from_numpy(x_t).to(device), list(uncond_embeddings.split(1))
+
+    def invert_batch(self, image_paths: List[str], prompts: List[str], offsets=(0, 0, 0, 0), num_inner_steps=10,
+                     early_stop_epsilon=1e-5, batch_size=4, verbose=False,
+                     policy: Optional[ConvergencePolicy] = None, use_cache=True):
+        # inverts the images batch_size at a time, offsets is one tuple for all images or one per image.
+        # images already in self.cache with the same prompt and settings are not inverted again, new inversions
+        # are added to it. use_cache=False neither reads nor writes the cache.
+        # returns what invert returns for every image, in order. self.reports has the InversionReport of every
+        # image, None for the ones from the cache
+        if policy is None:
+            policy = ConvergencePolicy(num_inner_steps, early_stop_epsilon)
+        if isinstance(offsets[0], int):
+            offsets = [offsets] * len(image_paths)
+        images_gt = [load_512(image_path, *image_offsets) for image_path, image_offsets in zip(image_paths, offsets)]
+        results = [None] * len(image_paths)
+        keys = [None] * len(image_paths)
+        self.reports = [None] * len(image_paths)
+        cache = self.cache if use_cache else None
+        if cache is not None:
+            for k in range(len(image_paths)):
+                keys[k] = self.cache_key(images_gt[k], offsets[k], prompts[k], policy)
+                results[k] = self.load_cached(keys[k], images_gt[k])
+        missing = [k for k in range(len(image_paths)) if results[k] is None]
+        if verbose and len(missing) < len(image_paths):
+            print(f"{len(image_paths) - len(missing)} inversions found in the cache")
         ptp_utils.register_attention_control(self.model, None)
-        image_gt = load_512(image_path, *offsets)
-        if verbose:
-            print("DDIM inversion...")
-        image_rec, ddim_latents = self.ddim_inversion(image_gt)
-        if verbose:
-            print("Null-text optimization...")
-        uncond_embeddings = self.null_optimization(ddim_latents, num_inner_steps, early_stop_epsilon)
-        return (image_gt, image_rec), ddim_latents[-1], uncond_embeddings
-
-    def __init__(self, model):
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start: start + batch_size]
+            self.init_prompts([prompts[k] for k in batch])
+            if verbose:
+                print(f"DDIM inversion of images {batch}...")
+            images_rec, ddim_latents = self.ddim_inversion(np.stack([images_gt[k] for k in batch]))
+            if verbose:
+                print("Null-text optimization...")
+            uncond_embeddings = self.null_optimization(ddim_latents, num_inner_steps, early_stop_epsilon, policy)
+            for i, k in enumerate(batch):
+                self.reports[k] = self.last_reports[i]
+                if verbose:
+                    print(f"image {k}: {self.reports[k].summary()}")
+                results[k] = ((images_gt[k], images_rec[i]), ddim_latents[-1][i: i + 1],
+                              [uncond_embeddings_step[i: i + 1] for uncond_embeddings_step in uncond_embeddings])
+                if cache is not None:
+                    cache.save(keys[k], results[k][1], results[k][2], images_rec[i], group=self.cache_group())
+        return results
+
+    def warm_start_trajectory(self, max_entries: int = 64) -> Optional[List[torch.Tensor]]:
+        # the mean null embedding of every step over the cached inversions, None without any
+        if self.cache is None:
+            return None
+        uncond_embeddings = self.cache.mean_uncond_embeddings(self.cache_group(), max_entries)
+        if uncond_embeddings is None or uncond_embeddings.shape[0] != NUM_DDIM_STEPS:
+            return None
+        uncond_embeddings = torch.from_numpy(uncond_embeddings).to(device, self.model.text_encoder.dtype)
+        return list(uncond_embeddings.split(1))
+
+    def invert_fast(self, image_paths: List[str], prompts: List[str], offsets=(0, 0, 0, 0), refine_steps=0,
+                    trajectory: Optional[List[torch.Tensor]] = None, batch_size=4, verbose=False,
+                    policy: Optional[ConvergencePolicy] = None):
+        # DDIM inversion with the null embeddings of a warm start trajectory instead of optimising them, then
+        # null-text optimisation with policy of only the first refine_steps timesteps (the noisiest ones). the
+        # trajectory is one (1, 77, d) embedding per step, by default the mean of the cached inversions and
+        # the plain "" embedding without any. returns what invert_batch returns, results are not cached
+        if trajectory is None:
+            trajectory = self.warm_start_trajectory()
+        if trajectory is None:
+            if verbose:
+                print("no cached inversions to warm start from, using the unconditional embedding")
+            trajectory = [ptp_utils.embedding_cache.get_uncond(self.model, 1)] * NUM_DDIM_STEPS
+        policy = (ConvergencePolicy() if policy is None else policy).first_steps(refine_steps, NUM_DDIM_STEPS)
+        if isinstance(offsets[0], int):
+            offsets = [offsets] * len(image_paths)
+        images_gt = [load_512(image_path, *image_offsets) for image_path, image_offsets in zip(image_paths, offsets)]
+        self.reports = [None] * len(image_paths)
+        results = []
+        ptp_utils.register_attention_control(self.model, None)
+        for start in range(0, len(image_paths), batch_size):
+            batch = list(range(start, min(start + batch_size, len(image_paths))))
+            self.init_prompts([prompts[k] for k in batch])
+            images_rec, ddim_latents = self.ddim_inversion(np.stack([images_gt[k] for k in batch]))
+            uncond_embeddings = self.null_optimization(ddim_latents, None, None, policy, init_embeddings=trajectory)
+            for i, k in enumerate(batch):
+                self.reports[k] = self.last_reports[i]
+                results.append(((images_gt[k], images_rec[i]), ddim_latents[-1][i: i + 1],
+                                [uncond_embeddings_step[i: i + 1] for uncond_embeddings_step in uncond_embeddings]))
+        return results
+
+    def reconstruct(self, x_t, uncond_embeddings, prompt: str) -> np.ndarray:
+        # the image an inversion generates back with its own prompt
+        images, _ = text2image_ldm_stable(self.model, [prompt], EmptyControl(), num_inference_steps=NUM_DDIM_STEPS,
+                                          guidance_scale=GUIDANCE_SCALE, latent=x_t,
+                                          uncond_embeddings=uncond_embeddings)
+        return images[0]
+
+    def invert(self, image_path: str, prompt: str, offsets=(0, 0, 0, 0), num_inner_steps=10, early_stop_epsilon=1e-5,
+               verbose=False, policy: Optional[ConvergencePolicy] = None):
+        return self.invert_batch([image_path], [prompt], offsets, num_inner_steps, early_stop_epsilon,
+                                 verbose=verbose, policy=policy)[0]
+
+    def __init__(self, model, cache: Optional[io_utils.InversionCache] = None):
         scheduler = DDIMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", clip_sample=False,
                                   set_alpha_to_one=False)
         self.model = model
         self.tokenizer = self.model.tokenizer
         self.model.scheduler.set_timesteps(NUM_DDIM_STEPS)
         self.prompt = None
+        self.prompts = None
         self.context = None
+        self.cache = cache
+        self.reports = []
+        self.last_reports = []
+
+
+class TierReport(NamedTuple):
+    name: str
+    seconds: float  # per image
+    mse: float  # of the reconstructions against the input images
+    psnr: float
+    mse_to_full: float  # against the reconstructions of the full null-text inversion
+
+
+def compare_inversion_tiers(null_inversion: NullInversion, image_paths: List[str], prompts: List[str],
+                            offsets=(0, 0, 0, 0), refine_steps=(0, 1, 5), policy: Optional[ConvergencePolicy] = None,
+                            verbose=True) -> List[TierReport]:
+    # reconstruction error and time of the full null-text inversion and of invert_fast with each number of
+    # refine_steps, to pick the speed tier of a request. the full inversions bypass the cache, so they are
+    # timed for real and the evaluated images never join the warm start trajectory
+    trajectory = null_inversion.warm_start_trajectory()
+    tiers = [("full", lambda: null_inversion.invert_batch(image_paths, prompts, offsets, policy=policy,
+                                                          use_cache=False))]
+    for steps in refine_steps:
+        tiers.append((f"fast, {steps} refined", functools.partial(
+            null_inversion.invert_fast, image_paths, prompts, offsets, refine_steps=steps, trajectory=trajectory,
+            policy=policy)))
+    reports, full_images = [], None
+    for name, invert in tiers:
+        start = time.perf_counter()
+        results = invert()
+        seconds = (time.perf_counter() - start) / len(image_paths)
+        images = [null_inversion.reconstruct(x_t, uncond_embeddings, prompt)
+                  for ((_, _), x_t, uncond_embeddings), prompt in zip(results, prompts)]
+        images_gt = np.stack([image_gt for (image_gt, _), _, _ in results]).astype(np.float64)
+        images = np.stack(images).astype(np.float64)
+        if full_images is None:
+            full_images = images
+        mse = float(((images - images_gt) ** 2).mean())
+        psnr = 10 * np.log10(255 ** 2 / max(mse, 1e-10))
+        reports.append(TierReport(name, seconds, mse, psnr, float(((images - full_images) ** 2).mean())))
+    if verbose:
+        for report in reports:
+            print(f"{report.name:>16}: {report.seconds:7.2f}s per image, mse {report.mse:8.2f}, "
+                  f"psnr {report.psnr:5.2f}dB, mse to full {report.mse_to_full:8.2f}")
+    return reports
 
 
 def make_controller(prompts: List[str], is_replace_controller: bool, cross_replace_steps: Dict[str, float], self_replace_steps: float, blend_words=None, equilizer_params=None) -> AttentionControlEdit:
     if blend_words is None:
         lb = None
     else:
-        lb = LocalBlend(prompts, blend_word)
+        lb = LocalBlend(prompts, blend_words)
+    if equilizer_params is not None:
+        # replace / refine and the re-weighting in one pass, with a single attention store
+        eq = get_equalizer(prompts[1], equilizer_params["words"], equilizer_params["values"])
+        return AttentionComposedEdit(prompts, NUM_DDIM_STEPS, cross_replace_steps=cross_replace_steps,
+                                     self_replace_steps=self_replace_steps, is_replace=is_replace_controller,
+                                     equalizer=eq, local_blend=lb)
     if is_replace_controller:
         controller = AttentionReplace(prompts, NUM_DDIM_STEPS, cross_replace_steps=cross_replace_steps, self_replace_steps=self_replace_steps, local_blend=lb)
     else:
         controller = AttentionRefine(prompts, NUM_DDIM_STEPS, cross_replace_steps=cross_replace_steps, self_replace_steps=self_replace_steps, local_blend=lb)
-    if equilizer_params is not None:
-        eq = get_equalizer(prompts[1], equilizer_params["words"], equilizer_params["values"])
-        controller = AttentionReweight(prompts, NUM_DDIM_STEPS, cross_replace_steps=cross_replace_steps,
-                                       self_replace_steps=self_replace_steps, equalizer=eq, local_blend=lb, controller=controller)
     return controller
 
 
@@ -236,22 +544,12 @@ def text2image_ldm_stable(
 ):
     batch_size = len(prompt)
     ptp_utils.register_attention_control(model, controller)
+    ptp_utils.set_prompts(controller, prompt)
     height = width = 512
 
-    text_input = model.tokenizer(
-        prompt,
-        padding="max_length",
-        max_length=model.tokenizer.model_max_length,
-        truncation=True,
-        return_tensors="pt",
-    )
-    text_embeddings = model.text_encoder(text_input.input_ids.to(model.device))[0]
-    max_length = text_input.input_ids.shape[-1]
+    text_embeddings = ptp_utils.embedding_cache.get(model, prompt)
     if uncond_embeddings is None:
-        uncond_input = model.tokenizer(
-            [""] * batch_size, padding="max_length", max_length=max_length, return_tensors="pt"
-        )
-        uncond_embeddings_ = model.text_encoder(uncond_input.input_ids.to(model.device))[0]
+        uncond_embeddings_ = ptp_utils.embedding_cache.get_uncond(model, batch_size)
     else:
         uncond_embeddings_ = None
 
@@ -302,7 +600,8 @@ if __name__ == "__main__":
     device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
     ldm_stable = StableDiffusionPipeline.from_pretrained("CompVis/stable-diffusion-v1-4",
                                                          scheduler=scheduler).to(device)
-    null_inversion = NullInversion(ldm_stable)
+    # repeated edits of the same photo and prompt reuse the inversion
+    null_inversion = NullInversion(ldm_stable, cache=io_utils.InversionCache(io_utils.output_path("inversion_cache")))
 
     image_path = "/cnvrg/data/input_images/harel/harel1.jpg"
     prompt = "a man smiling over a mountain view"
@@ -0,0 +1,135 @@
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# memory of the attention edits over one diffusion step: the in place AttentionControlEdit path vs. the previous
+# out of place one (replicated below on the same controllers), run with `python benchmarks/bench_attention_edit_memory.py`.
+# loads the pipeline like p2p_games does. on CUDA this reports the peak allocation above the attention maps
+# themselves, on CPU the bytes allocated by the edits
+
+# (place_in_unet, resolution, heads) of the stable diffusion 2.1 attention layers, in call order
+LAYERS = [("down", 64, 5)] * 2 + [("down", 32, 10)] * 2 + [("down", 16, 20)] * 2 + [("mid", 8, 20)] + \
+         [("up", 16, 20)] * 3 + [("up", 32, 10)] * 3 + [("up", 64, 5)] * 3
+
+
+def legacy_call(controller, attn, is_cross: bool, place_in_unet: str):
+    # AttentionControl.__call__ and AttentionControlEdit.forward as they were before the edits worked in place
+    h = attn.shape[0]
+    attn[h // 2:] = legacy_forward(controller, attn[h // 2:], is_cross)
+
+
+def legacy_forward(controller, attn, is_cross: bool):
+    if is_cross or (controller.num_self_replace[0] <= controller.cur_step < controller.num_self_replace[1]):
+        h = attn.shape[0] // controller.batch_size
+        attn = attn.reshape(controller.batch_size, h, *attn.shape[1:])
+        attn_base, attn_repalce = attn[0], attn[1:]
+        if is_cross:
+            alpha_words = controller.cross_replace_alpha[controller.cur_step]
+            attn_repalce_new = legacy_replace_cross_attention(controller, attn_base, attn_repalce) * alpha_words + (
+                    1 - alpha_words) * attn_repalce
+            attn[1:] = attn_repalce_new
+        elif attn_repalce.shape[2] <= 16 ** 2:
+            attn[1:] = attn_base.unsqueeze(0).expand(attn_repalce.shape[0], *attn_base.shape)
+        else:
+            attn[1:] = attn_repalce
+        attn = attn.reshape(controller.batch_size * h, *attn.shape[2:])
+    return attn
+
+
+def legacy_replace_cross_attention(controller, attn_base, att_replace):
+    # the replace_cross_attention of AttentionReplace, AttentionRefine and AttentionReweight (without a
+    # previous controller), on the dense mappers set by add_legacy_mapper
+    import p2p_games
+    if isinstance(controller, p2p_games.AttentionReplace):
+        return torch.einsum('hpw,bwn->bhpn', attn_base, controller.legacy_mapper)
+    if isinstance(controller, p2p_games.AttentionRefine):
+        attn_base_replace = attn_base[:, :, controller.legacy_mapper].permute(2, 0, 1, 3)
+        return attn_base_replace * controller.legacy_alphas + att_replace * (1 - controller.legacy_alphas)
+    return attn_base[None, :, :, :] * controller.equalizer[:, None, None, :]
+
+
+def add_legacy_mapper(controller, prompts):
+    # the mappers the controllers kept before they were compacted
+    import p2p_games
+    if isinstance(controller, p2p_games.AttentionReplace):
+        controller.legacy_mapper = p2p_games.seq_aligner.get_replacement_mapper(prompts, p2p_games.tokenizer).to(
+            p2p_games.device)
+    elif isinstance(controller, p2p_games.AttentionRefine):
+        mapper, alphas = p2p_games.seq_aligner.get_refinement_mapper(prompts, p2p_games.tokenizer)
+        controller.legacy_mapper, alphas = mapper.to(p2p_games.device), alphas.to(p2p_games.device)
+        controller.legacy_alphas = alphas.reshape(alphas.shape[0], 1, 1, alphas.shape[1])
+    return controller
+
+
+def run_step(controller, call, device, num_tokens=77):
+    # the softmaxed maps of every layer, uncond and cond halves, as the attention hook hands them over
+    for place_in_unet, res, heads in LAYERS:
+        for is_cross in (False, True):
+            attn = torch.rand(2 * controller.batch_size * heads, res ** 2, num_tokens if is_cross else res ** 2,
+                              device=device)
+            call(controller, attn, is_cross, place_in_unet)
+            del attn
+
+
+def measure(controller, call, device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        maps_peak = 0
+        for place_in_unet, res, heads in LAYERS:
+            maps_peak = max(maps_peak, 2 * controller.batch_size * heads * res ** 2 * max(77, res ** 2) * 4)
+        start = time.perf_counter()
+        base = torch.cuda.memory_allocated()
+        run_step(controller, call, device)
+        torch.cuda.synchronize()
+        return time.perf_counter() - start, torch.cuda.max_memory_allocated() - base - maps_peak
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        run_step(controller, lambda *args: None, device)
+    maps_bytes = sum(max(event.self_cpu_memory_usage, 0) for event in prof.key_averages())
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        start = time.perf_counter()
+        run_step(controller, call, device)
+        elapsed = time.perf_counter() - start
+    return elapsed, sum(max(event.self_cpu_memory_usage, 0) for event in prof.key_averages()) - maps_bytes
+
+
+def main():
+    import p2p_games
+    device = torch.device(p2p_games.device)
+    prompts = ["a cat sitting on a bench", "a dog sitting on a bench"]
+    num_steps = p2p_games.NUM_DIFFUSION_STEPS
+    cross_replace_steps = {"default_": .8, "dog": .4}
+    refine_prompts = [prompts[0], "a dog sitting on a wooden bench"]
+    equalizer = p2p_games.get_equalizer(prompts[1], ("dog",), (2.,))
+    controllers = {
+        "replace": lambda: add_legacy_mapper(p2p_games.AttentionReplace(prompts, num_steps, cross_replace_steps, .4,
+                                                                        store_attention=False), prompts),
+        "refine": lambda: add_legacy_mapper(p2p_games.AttentionRefine(refine_prompts, num_steps, cross_replace_steps,
+                                                                      .4, store_attention=False), refine_prompts),
+        "reweight": lambda: p2p_games.AttentionReweight(prompts, num_steps, cross_replace_steps, .4,
+                                                        equalizer=equalizer, store_attention=False),
+    }
+    for name, make_controller in controllers.items():
+        # step 0 replaces every word, the later one only the words past their own window
+        for step in (0, int(.6 * num_steps)):
+            results = {}
+            for path, call in (("out of place", legacy_call), ("in place", lambda c, *args: c(*args))):
+                controller = make_controller()
+                controller.num_att_layers = 2 * len(LAYERS)
+                controller.cur_step = step
+                run_step(controller, call, device)  # warm up, the in place path allocates its scratch buffers here
+                controller.cur_step = step
+                results[path] = measure(controller, call, device)
+                controller.cur_step = step
+            mode = controller.cross_replace_modes[step]
+            for path, (elapsed, extra) in results.items():
+                print(f"{name:>8} step {step:>2} ({mode:>7}) {path:>12}: {extra / 2 ** 20:9.1f} MiB, "
+                      f"{elapsed * 1e3:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# null-text optimisation of one image over the first few timesteps, run with
+# `python benchmarks/bench_null_inversion.py`: the UNet weights left requiring grad (as before the freeze) vs.
+# the frozen UNet. epsilon is 0, every timestep runs all of its inner steps
+
+NUM_STEPS = 5
+
+
+def run(null_inversion, ddim_latents, freeze: bool):
+    import Null_games
+    policy = Null_games.ConvergencePolicy(epsilon=0, epsilon_slope=0).first_steps(NUM_STEPS, Null_games.NUM_DDIM_STEPS)
+    unet = null_inversion.model.unet
+    if not freeze:
+        # null_optimization freezes the UNet through requires_grad_, skipped here
+        unet.requires_grad_ = lambda requires_grad=True: unet
+    try:
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        uncond_embeddings = null_inversion.null_optimization(ddim_latents, None, None, policy)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return time.perf_counter() - start, torch.cat(uncond_embeddings[:NUM_STEPS])
+    finally:
+        if not freeze:
+            del unet.requires_grad_
+
+
+def main():
+    import Null_games
+    from diffusers import StableDiffusionPipeline, DDIMScheduler
+    device = torch.device('cuda:0') if torch.cuda.is_available() else torch.device('cpu')
+    scheduler = DDIMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", clip_sample=False,
+                              set_alpha_to_one=False)
+    ldm_stable = StableDiffusionPipeline.from_pretrained("CompVis/stable-diffusion-v1-4",
+                                                         scheduler=scheduler).to(device)
+    null_inversion = Null_games.NullInversion(ldm_stable)
+    Null_games.ptp_utils.register_attention_control(ldm_stable, None)
+    image = np.random.default_rng(0).integers(0, 256, (1, 512, 512, 3), dtype=np.uint8)
+    null_inversion.init_prompts(["a photo of a mountain view"])
+    _, ddim_latents = null_inversion.ddim_inversion(image)
+    run(null_inversion, ddim_latents, True)  # warm up
+    results = {}
+    for name, freeze in (("unfrozen", False), ("frozen", True)):
+        results[name] = run(null_inversion, ddim_latents, freeze)
+    reference = results["frozen"][1]
+    for name, (elapsed, uncond_embeddings) in results.items():
+        difference = (uncond_embeddings - reference).abs().max().item()
+        print(f"{name:>8}: {elapsed:7.2f} s, max |embedding - frozen| {difference:.2e}")
+
+
+if __name__ == "__main__":
+    main()
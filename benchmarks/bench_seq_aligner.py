@@ -0,0 +1,65 @@
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import seq_aligner
+
+# Needleman-Wunsch on full length (77 token) prompts: cell by cell loop vs. the anti-diagonal global_align,
+# run with `python benchmarks/bench_seq_aligner.py`
+
+MAX_LEN = 77
+BOS, EOS = 49406, 49407
+
+
+def make_source(rng):
+    return [BOS] + rng.integers(0, 49405, MAX_LEN - 2).tolist() + [EOS]
+
+
+def make_edit(x, rng):
+    # the source with a few inserted / deleted / replaced words
+    y = np.array(x[1:-1])
+    for _ in range(3):
+        pos = rng.integers(0, len(y))
+        y = np.insert(y, pos, rng.integers(0, 49405, rng.integers(1, 4)))
+        y = np.delete(y, rng.integers(0, len(y)))
+    y[rng.integers(0, len(y), 2)] = rng.integers(0, 49405, 2)
+    return [BOS] + y[:MAX_LEN - 2].tolist() + [EOS]
+
+
+def main(num_pairs=20, repeat=3):
+    rng = np.random.default_rng(0)
+    sources = [make_source(rng) for _ in range(num_pairs)]
+    pairs = [(x, make_edit(x, rng)) for x in sources]
+    score = seq_aligner.ScoreParams(0, 1, -1)
+
+    for x, y in pairs:
+        matrix, trace_back = seq_aligner.global_align(x, y, score)
+        matrix_ref, trace_back_ref = seq_aligner.global_align_loop(x, y, score)
+        assert (matrix == matrix_ref).all() and (trace_back == trace_back_ref).all()
+
+    timings = {}
+    for name, align in (("loop", seq_aligner.global_align_loop), ("wavefront", seq_aligner.global_align)):
+        run = lambda: [align(x, y, score) for x, y in pairs]
+        timings[name] = min(timeit.repeat(run, number=1, repeat=repeat)) / num_pairs
+        print(f"{name:>10}: {timings[name] * 1e3:8.3f} ms per {MAX_LEN} token pair")
+    print(f"speedup: {timings['loop'] / timings['wavefront']:.1f}x")
+
+    ids = [(tuple(x), tuple(y)) for x, y in pairs]
+    seq_aligner.alignment_cache.clear()
+    cold = timeit.timeit(lambda: [seq_aligner.align_token_ids(*item) for item in ids], number=1) / num_pairs
+    warm = timeit.timeit(lambda: [seq_aligner.align_token_ids(*item) for item in ids], number=1) / num_pairs
+    print(f"align_token_ids cold: {cold * 1e3:8.3f} ms, cached: {warm * 1e6:8.3f} us per pair")
+
+    # one source against all of its edits, as in get_refinement_mapper
+    x_seq = tuple(sources[0])
+    y_seqs = [tuple(make_edit(sources[0], rng)) for _ in range(num_pairs)]
+    for name, align in (("one by one", lambda: [seq_aligner.global_align(x_seq, y, score) for y in y_seqs]),
+                        ("batched", lambda: seq_aligner.global_align_batch(x_seq, y_seqs, score))):
+        elapsed = min(timeit.repeat(align, number=1, repeat=repeat))
+        print(f"{name:>10}: {elapsed * 1e3:8.3f} ms for {num_pairs} edits of one source")
+
+if __name__ == "__main__":
+    main()
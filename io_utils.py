@@ -0,0 +1,385 @@
+import atexit
+import base64
+import hashlib
+import json
+import os
+import queue
+import struct
+import threading
+import zipfile
+import zlib
+from typing import Optional, List, Dict, NamedTuple, Callable, Sequence
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+def atomic_write(path: str, write):
+    # write(tmp_path) into a temporary file next to path, then rename, readers never see a partial file. the
+    # temporary name is unique per thread, writers of the same path don't share it
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}{os.path.splitext(path)[1]}"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def save_image(image: np.ndarray, path: str, **kwargs):
+    atomic_write(path, lambda tmp_path: Image.fromarray(image).save(tmp_path, **kwargs))
+
+
+def write_png_strip(tiles: Sequence[np.ndarray], path: str, band_rows: int = 64, compress_level: int = 6):
+    # the PNG of np.hstack(tiles), encoded band by band of scanlines so the full strip never exists in memory
+    channels = 1 if tiles[0].ndim == 2 else tiles[0].shape[2]
+    height, width = tiles[0].shape[0], sum(tile.shape[1] for tile in tiles)
+    color_type = {1: 0, 3: 2, 4: 6}[channels]
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+    def write(tmp_path):
+        compressor = zlib.compressobj(compress_level)
+        with open(tmp_path, "wb") as f:
+            f.write(b"\x89PNG\r\n\x1a\n")
+            f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)))
+            for top in range(0, height, band_rows):
+                rows = min(band_rows, height - top)
+                # every scanline starts with its filter type, 0 (none)
+                band = np.zeros((rows, 1 + width * channels), dtype=np.uint8)
+                band[:, 1:] = np.concatenate([tile[top: top + rows].reshape(rows, -1) for tile in tiles], axis=1)
+                data = compressor.compress(band.tobytes())
+                if data:
+                    f.write(chunk(b"IDAT", data))
+            f.write(chunk(b"IDAT", compressor.flush()))
+            f.write(chunk(b"IEND", b""))
+
+    atomic_write(path, write)
+
+
+def load_image(path: str) -> np.ndarray:
+    return np.array(Image.open(path))
+
+
+# results go under $PTP_OUTPUT_ROOT, /cnvrg when it is not set
+OUTPUT_ROOT = os.environ.get("PTP_OUTPUT_ROOT", "/cnvrg")
+
+
+def output_path(*parts: str) -> str:
+    return os.path.join(OUTPUT_ROOT, *parts)
+
+
+class ImageSink:
+    # encodes and writes uint8 images on background threads. the queue is bounded: when the writers fall
+    # behind, save blocks instead of piling up images in memory. the arrays are not copied, do not write into
+    # them after handing them over
+
+    def save(self, image: np.ndarray, path: str, **kwargs):
+        self.save_all({path: image}, **kwargs)
+
+    def save_strip(self, tiles: Sequence[np.ndarray], path: str, on_done: Optional[Callable[[], None]] = None):
+        # np.hstack(tiles) as a PNG, see write_png_strip
+        self.put([(write_png_strip, (tiles, path), {})], on_done)
+
+    def save_all(self, images: Dict[str, np.ndarray], on_done: Optional[Callable[[], None]] = None, **kwargs):
+        # on_done runs on a writer thread once all of images are on disk
+        self.put([(save_image, (image, path), kwargs) for path, image in images.items()], on_done)
+
+    def put(self, writes, on_done: Optional[Callable[[], None]]):
+        self.raise_error()
+        group = {"remaining": len(writes), "on_done": on_done}
+        for write in writes:
+            self.queue.put((write, group))
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                (write, args, kwargs), group = item
+                write(*args, **kwargs)
+                with self.lock:
+                    group["remaining"] -= 1
+                    done = group["remaining"] == 0
+                if done and group["on_done"] is not None:
+                    group["on_done"]()
+            except BaseException as e:
+                with self.lock:
+                    self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def raise_error(self):
+        with self.lock:
+            if self.errors:
+                error, self.errors = self.errors[0], []
+                raise RuntimeError("writing an image failed") from error
+
+    def wait(self):
+        # blocks until everything handed over so far is written, without raising the writers' errors
+        self.queue.join()
+
+    def flush(self):
+        self.wait()
+        self.raise_error()
+
+    def close(self):
+        if self.threads:
+            self.queue.join()
+            for _ in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+            self.threads = []
+        self.raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __init__(self, num_workers: int = 2, max_pending: int = 16):
+        self.queue = queue.Queue(max_pending)
+        self.lock = threading.Lock()
+        self.errors = []
+        self.threads = [threading.Thread(target=self.worker, daemon=True) for _ in range(num_workers)]
+        for thread in self.threads:
+            thread.start()
+
+
+_default_sink = None
+
+
+def default_sink() -> ImageSink:
+    # shared by view_images and the sweeps, drained when the interpreter exits
+    global _default_sink
+    if _default_sink is None:
+        _default_sink = ImageSink()
+        atexit.register(_default_sink.close)
+    return _default_sink
+
+
+def job_id(job: NamedTuple) -> str:
+    return hashlib.sha1(json.dumps(job._asdict(), sort_keys=True).encode()).hexdigest()
+
+
+def encode_generator_state(generator: torch.Generator) -> str:
+    return base64.b64encode(generator.get_state().numpy().tobytes()).decode()
+
+
+def decode_generator_state(state: str, device="cpu") -> torch.Generator:
+    generator = torch.Generator(device)
+    generator.set_state(torch.from_numpy(np.frombuffer(base64.b64decode(state), dtype=np.uint8).copy()))
+    return generator
+
+
+class SweepManifest:
+    # one json line per finished job: the job, the generator state its latent was drawn from and its outputs.
+    # lines are appended only after the outputs are on disk, so a job in the manifest never has to be redone.
+    # record may be called from the writer threads of an ImageSink
+
+    def is_done(self, job: NamedTuple) -> bool:
+        return job_id(job) in self.records
+
+    def pending(self, jobs: List[NamedTuple]) -> List[NamedTuple]:
+        return [job for job in jobs if not self.is_done(job)]
+
+    def outputs(self, job: NamedTuple) -> Dict[str, str]:
+        return self.records[job_id(job)]["outputs"]
+
+    def record(self, job: NamedTuple, outputs: Dict[str, str], generator_state: Optional[str] = None, **params):
+        record = {"job_id": job_id(job), "job": job._asdict(), "generator_state": generator_state,
+                  "outputs": outputs, **params}
+        with self.lock, open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+            self.records[record["job_id"]] = record
+
+    def load(self):
+        self.records = {}
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            if not data.endswith(b"\n"):
+                # drop the tail of a line that was being written when the sweep died
+                f.truncate(data.rfind(b"\n") + 1)
+        with open(self.path) as f:
+            for line in f:
+                record = json.loads(line)
+                self.records[record["job_id"]] = record
+
+    def __len__(self):
+        return len(self.records)
+
+    def __init__(self, path: str):
+        self.path = path
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.records = {}
+        self.lock = threading.Lock()
+        self.load()
+
+
+class InversionCache:
+    # null-text inversions on disk under cache_dir, one npz per key: x_t, the null embedding of every step in
+    # fp16 and the VAE reconstruction. the least recently used files are deleted once the folder is larger
+    # than max_bytes, a hit counts as a use. group names the inversions whose embeddings are comparable (same
+    # model and schedule), mean_uncond_embeddings averages over them
+
+    @staticmethod
+    def key(image: np.ndarray, *params) -> str:
+        # image is the load_512 output, params whatever else the inversion depends on
+        h = hashlib.sha1(image.tobytes())
+        h.update(json.dumps([list(image.shape), *params], default=str).encode())
+        return h.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def load(self, key: str):
+        # (x_t, uncond_embeddings, image_rec) as numpy arrays, None on a miss
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                entry = data["x_t"], data["uncond_embeddings"], data["image_rec"]
+            os.utime(path)
+        except OSError:
+            return None
+        except (KeyError, ValueError, EOFError, zipfile.BadZipFile):
+            # truncated or not an inversion, dropped so the inversion is run and saved again
+            self.discard(path)
+            return None
+        return entry
+
+    def entry_names(self) -> List[str]:
+        # the cache files, without the temporary files of writes in flight or of writers that died (atomic_write
+        # names them <key>.npz.tmp<pid>.<tid>.npz)
+        return [name for name in os.listdir(self.cache_dir) if name.endswith(".npz") and ".tmp" not in name]
+
+    def discard(self, path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def save(self, key: str, x_t: torch.Tensor, uncond_embeddings: List[torch.Tensor], image_rec: np.ndarray,
+             group: str = ""):
+        def write(tmp_path):
+            with open(tmp_path, "wb") as f:
+                np.savez(f, x_t=x_t.detach().cpu().numpy(),
+                         uncond_embeddings=torch.cat(uncond_embeddings).detach().half().cpu().numpy(),
+                         image_rec=image_rec, group=np.array(group))
+
+        atomic_write(self.path(key), write)
+        self.evict()
+
+    def entry_info(self, name: str, stat: os.stat_result):
+        # (group, shape of uncond_embeddings) of a cache file, from the npy headers without reading the arrays.
+        # remembered per file, a rewritten file has a new inode. None when it can't be read
+        info_key = (name, stat.st_ino)
+        if info_key not in self.entry_infos:
+            path = os.path.join(self.cache_dir, name)
+            try:
+                with np.load(path) as data:
+                    # entries saved without a group are never averaged
+                    group = str(data["group"]) if "group" in data.files else None
+                    with data.zip.open("uncond_embeddings.npy") as f:
+                        version = np.lib.format.read_magic(f)
+                        read_header = (np.lib.format.read_array_header_1_0 if version == (1, 0)
+                                       else np.lib.format.read_array_header_2_0)
+                        shape = read_header(f)[0]
+            except OSError:
+                return None
+            except (KeyError, ValueError, EOFError, zipfile.BadZipFile):
+                self.discard(path)
+                return None
+            self.entry_infos[info_key] = group, shape
+        return self.entry_infos[info_key]
+
+    def mean_uncond_embeddings(self, group: str, max_entries: int = 64) -> Optional[np.ndarray]:
+        # the mean null embedding trajectory, (steps, 77, d) float32, of the max_entries most recently used
+        # inversions of group. None when there are none. reading them does not count as a use. the files are
+        # picked from their headers and the mean is kept in memory until the set of picked files changes, so
+        # repeated calls and cache hits (which only reorder them) don't decode the embeddings again
+        entries = []
+        for name in self.entry_names():
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, name, stat))
+        # forget the files that are gone
+        names = {(name, stat.st_ino) for _, name, stat in entries}
+        self.entry_infos = {key: info for key, info in self.entry_infos.items() if key in names}
+        selected, shape = [], None
+        for _, name, stat in sorted(entries, key=lambda entry: entry[:2], reverse=True):
+            if len(selected) == max_entries:
+                break
+            info = self.entry_info(name, stat)
+            if info is None or info[0] != group or (shape is not None and info[1] != shape):
+                continue
+            shape = info[1]
+            selected.append((name, stat.st_ino))
+        if not selected:
+            return None
+        picked = frozenset(selected)
+        mean_key = (group, max_entries)
+        if mean_key in self.means and self.means[mean_key][0] == picked:
+            return self.means[mean_key][1].copy()
+        total, count, complete = None, 0, True
+        for name, _ in selected:
+            path = os.path.join(self.cache_dir, name)
+            try:
+                with np.load(path) as data:
+                    uncond_embeddings = data["uncond_embeddings"].astype(np.float32)
+            except OSError:
+                complete = False
+                continue
+            except (KeyError, ValueError, EOFError, zipfile.BadZipFile):
+                self.discard(path)
+                complete = False
+                continue
+            total = uncond_embeddings if total is None else total + uncond_embeddings
+            count += 1
+        if total is None:
+            return None
+        mean = total / count
+        # a mean missing some of the picked files is not kept, the next call picks again
+        if complete:
+            self.means[mean_key] = picked, mean
+        return mean.copy()
+
+    def evict(self):
+        entries = []
+        for name in self.entry_names():
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.discard(os.path.join(self.cache_dir, name))
+            total -= size
+
+    def __len__(self):
+        return len(self.entry_names())
+
+    def __init__(self, cache_dir: str, max_bytes: int = 2 * 2 ** 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entry_infos = {}
+        self.means = {}
+        os.makedirs(cache_dir, exist_ok=True)
@@ -1,4 +1,4 @@
-from typing import Optional, Union, Tuple, List, Callable, Dict
+from typing import Optional, Union, Tuple, List, Callable, Dict, NamedTuple, Iterator
 
 import matplotlib.pyplot as plt
 import torch
@@ -7,8 +7,11 @@ from diffusers import StableDiffusionPipeline
 import torch.nn.functional as nnf
 import numpy as np
 import abc
+import functools
+import itertools
 import ptp_utils
 import seq_aligner
+import io_utils
 import random
 import os
 import transformers
@@ -38,31 +41,73 @@ tokenizer = ldm_stable.tokenizer
 #            ]
 
 
+class LocalBlendState:
+    # the running mean a LocalBlend keeps for one controller. a LocalBlend itself holds no state, it can be shared
+    # by several controllers and runs
+
+    def __init__(self):
+        self.maps = None
+        self.step_maps = None
+        self.step_heads = 0
+        self.num_steps = 0
+
+
 class LocalBlend:
+    # keeps a running mean of the 16x16 down / up cross attention, already summed over the blend words and
+    # averaged over heads and layers, instead of reading the maps back from an attention store every step.
+    # the mean lives in the LocalBlendState of the controller using the blend
+
+    def attention_specs(self) -> List[ptp_utils.LayerSpec]:
+        return [ptp_utils.LayerSpec(is_cross=True, places=("down", "up"), max_res=16)]
+
+    def accumulate(self, attn, is_cross: bool, place_in_unet: str, state: LocalBlendState):
+        # attn is the (edited) conditional half, (batch * heads, pixels, tokens)
+        if not (is_cross and place_in_unet in ("down", "up") and attn.shape[1] == 16 ** 2):
+            return
+        batch_size, num_words = self.word_inds.shape
+        attn = attn.reshape(batch_size, -1, *attn.shape[1:])
+        words = attn.gather(3, self.word_inds[:, None, None, :].expand(*attn.shape[:3], num_words))
+        if self.word_mask is not None:
+            words = words * self.word_mask[:, None, None, :]
+        step_maps = words.sum((1, 3), dtype=torch.float32)
+        if state.step_maps is None:
+            state.step_maps = step_maps
+        else:
+            state.step_maps += step_maps
+        state.step_heads += attn.shape[1]
 
-    def __call__(self, x_t, attention_store):
+    def __call__(self, x_t, state: LocalBlendState):
         k = 1
-        maps = attention_store["down_cross"][2:4] + attention_store["up_cross"][:3]
-        maps = [item.reshape(self.alpha_layers.shape[0], -1, 1, 16, 16, MAX_NUM_WORDS) for item in maps]
-        maps = torch.cat(maps, dim=1)
-        maps = (maps * self.alpha_layers).sum(-1).mean(1) # 1. alpha zeros out irrlevent stap. 2. we sum it out over the last dim[tokens]. 3. then we average over all the heads
+        # close the step: its layer / head mean joins the running mean over steps
+        step_maps = state.step_maps / state.step_heads
+        if state.maps is None:
+            state.maps = step_maps
+        else:
+            state.maps.lerp_(step_maps, 1 / (state.num_steps + 1))
+        state.step_maps, state.step_heads = None, 0
+        state.num_steps += 1
+        # pooling, normalising and thresholding at 16x16 give the same mask as at the latent size, nearest
+        # upsampling only repeats pixels
+        maps = state.maps.reshape(-1, 1, 16, 16)
         mask = nnf.max_pool2d(maps, (k * 2 + 1, k * 2 + 1), (1, 1), padding=(k, k))
-        mask = nnf.interpolate(mask, size=(x_t.shape[2:]))
-        mask = mask / mask.max(2, keepdims=True)[0].max(3, keepdims=True)[0]
+        mask = mask / mask.amax((2, 3), keepdim=True)
         mask = mask.gt(self.threshold)
-        mask = (mask[:1] + mask[1:]).float()
-        x_t = x_t[:1] + mask * (x_t - x_t[:1])
-        return x_t
+        mask = mask[:1] | mask[1:]
+        mask = nnf.interpolate(mask.to(x_t.dtype), size=x_t.shape[2:]).bool()
+        return torch.cat([x_t[:1], torch.where(mask, x_t[1:], x_t[:1])])
 
     def __init__(self, prompts: List[str], words: [List[List[str]]], threshold=.3):
-        alpha_layers = torch.zeros(len(prompts), 1, 1, 1, 1, MAX_NUM_WORDS)
+        word_inds = []
         for i, (prompt, words_) in enumerate(zip(prompts, words)):
             if type(words_) is str:
                 words_ = [words_]
-            for word in words_:
-                ind = ptp_utils.get_word_inds(prompt, word, tokenizer)
-                alpha_layers[i, :, :, :, :, ind] = 1
-        self.alpha_layers = alpha_layers.to(device)
+            word_inds.append(sorted(set(ind for word in words_
+                                        for ind in ptp_utils.get_word_inds(prompt, word, tokenizer).tolist())))
+        # token indices of the blend words per prompt, padded to the longest with masked out zeros
+        num_words = max(max(len(inds) for inds in word_inds), 1)
+        self.word_inds = torch.tensor([inds + [0] * (num_words - len(inds)) for inds in word_inds]).to(device)
+        word_mask = torch.tensor([[1.] * len(inds) + [0.] * (num_words - len(inds)) for inds in word_inds])
+        self.word_mask = None if word_mask.bool().all() else word_mask.to(device)
         self.threshold = threshold
 
 
@@ -82,32 +127,56 @@ class AttentionControl(abc.ABC):
     def forward(self, attn, is_cross: bool, place_in_unet: str):
         raise NotImplementedError
 
+    def attention_specs(self) -> List[ptp_utils.LayerSpec]:
+        # the layers and steps forward has to see, declared up front
+        return [ptp_utils.LayerSpec()]
+
+    def needs_attention(self, is_cross: bool, place_in_unet: str, num_pixels: int):
+        # layers answering False go through a fused attention kernel and never reach forward
+        if self.cur_att_layer < self.num_uncond_att_layers:
+            return False
+        if self.layer_specs is None:
+            self.layer_specs = self.attention_specs()
+        return any(spec.matches(is_cross, place_in_unet, num_pixels, self.cur_step) for spec in self.layer_specs)
+
     def __call__(self, attn, is_cross: bool, place_in_unet: str):
         if self.cur_att_layer >= self.num_uncond_att_layers:
             if LOW_RESOURCE:
                 attn = self.forward(attn, is_cross, place_in_unet)
             else:
                 h = attn.shape[0]
-                attn[h // 2:] = self.forward(attn[h // 2:], is_cross, place_in_unet)
+                attn_cond = attn[h // 2:]
+                attn_out = self.forward(attn_cond, is_cross, place_in_unet)
+                # edits work in place, copy only what a forward returned in new memory
+                if attn_out.data_ptr() != attn_cond.data_ptr():
+                    attn_cond.copy_(attn_out)
+        self.end_layer()
+        return attn
+
+    def end_layer(self):
         self.cur_att_layer += 1
         if self.cur_att_layer == self.num_att_layers + self.num_uncond_att_layers:
             self.cur_att_layer = 0
             self.cur_step += 1
             self.between_steps()
-        return attn
 
     def reset(self):
         self.cur_step = 0
         self.cur_att_layer = 0
+        self.layer_specs = None
 
     def __init__(self):
         self.cur_step = 0
         self.num_att_layers = -1
         self.cur_att_layer = 0
+        self.layer_specs = None
 
 
 class EmptyControl(AttentionControl):
 
+    def attention_specs(self):
+        return []
+
     def forward(self, attn, is_cross: bool, place_in_unet: str):
         return attn
 
@@ -119,117 +188,287 @@ class AttentionStore(AttentionControl):
         return {"down_cross": [], "mid_cross": [], "up_cross": [],
                 "down_self": [], "mid_self": [], "up_self": []}
 
+    def store_specs(self) -> List[ptp_utils.LayerSpec]:
+        # stored layers are kept at every step
+        return [ptp_utils.LayerSpec(max_res=self.store_max_res)]
+
+    def attention_specs(self):
+        return self.store_specs()
+
     def forward(self, attn, is_cross: bool, place_in_unet: str):
         key = f"{place_in_unet}_{'cross' if is_cross else 'self'}"
-        if attn.shape[1] <= 32 ** 2:  # avoid memory overhead
-            self.step_store[key].append(attn)
+        if self.stored_specs is None:
+            self.stored_specs = self.store_specs()
+        if any(spec.matches_layer(is_cross, place_in_unet, attn.shape[1]) for spec in self.stored_specs):
+            self.accumulate(key, attn)
         return attn
 
-    def between_steps(self):
-
-        if len(self.attention_store) == 0:
-            self.attention_store = self.step_store
+    def accumulate(self, key, attn):
+        # running mean over steps, one buffer per stored layer allocated on the first step
+        self.aggregate_cache.clear()
+        store = self.attention_store[key]
+        index = self.store_index[key]
+        self.store_index[key] += 1
+        if index == len(store):
+            store.append(attn.to(dtype=self.store_dtype or attn.dtype, copy=True))
         else:
-            for key in self.attention_store:
-                for i in range(len(self.attention_store[key])):
-                    self.attention_store[key][i] += self.step_store[key][i]
-        self.step_store = self.get_empty_store()
+            store[index].lerp_(attn.to(store[index].dtype), 1 / (self.cur_step + 1))
+
+    def between_steps(self):
+        for key in self.store_index:
+            self.store_index[key] = 0
 
     def get_average_attention(self):
-        average_attention = {key: [item / self.cur_step for item in self.attention_store[key]] for key in
-                             self.attention_store}
-        return average_attention
+        # the stored buffers already hold the average, don't modify them in place
+        return {key: list(self.attention_store[key]) for key in self.attention_store}
+
+    def aggregate(self, res: int, from_where: List[str], is_cross: bool) -> torch.Tensor:
+        # (batch, res, res, keys) maps averaged over the heads and the from_where layers of resolution res.
+        # cached until the next stored step, the result is shared so don't modify it in place
+        key = (res, tuple(from_where), is_cross)
+        if key not in self.aggregate_cache:
+            if self.batch_size is None:
+                raise ValueError("batch_size is unknown, run the store through a text2image call first")
+            items = [item.reshape(self.batch_size, -1, res, res, item.shape[-1])
+                     for location in from_where
+                     for item in self.attention_store[f"{location}_{'cross' if is_cross else 'self'}"]
+                     if item.shape[1] == res ** 2]
+            if not items:
+                raise ValueError(f"no {res}x{res} attention stored for {from_where}, layers above store_max_res "
+                                 f"({self.store_max_res}) are not stored")
+            maps = torch.cat(items, dim=1)
+            self.aggregate_cache[key] = maps.sum(1) / maps.shape[1]
+        return self.aggregate_cache[key]
 
     def reset(self):
         super(AttentionStore, self).reset()
-        self.step_store = self.get_empty_store()
-        self.attention_store = {}
+        self.attention_store = self.get_empty_store()
+        self.store_index = {key: 0 for key in self.attention_store}
+        self.stored_specs = None
+        self.aggregate_cache = {}
 
-    def __init__(self):
+    def __init__(self, store_dtype: Optional[torch.dtype] = None, batch_size: Optional[int] = None,
+                 store_max_res: Optional[int] = 32):
 
         super(AttentionStore, self).__init__()
-        self.step_store = self.get_empty_store()
-        self.attention_store = {}
+        self.attention_store = self.get_empty_store()
+        self.store_index = {key: 0 for key in self.attention_store}
+        self.stored_specs = None
+        self.aggregate_cache = {}
+        # e.g. torch.float16 to halve the memory of the stored maps
+        self.store_dtype = store_dtype
+        # number of prompts. when left None text2image sets it on every run, so a reused store follows the
+        # batch it last ran
+        self.batch_size = batch_size
+        self.infer_batch_size = batch_size is None
+        # the prompts of the last run, set by text2image, show_cross_attention labels the maps with their tokens
+        self.prompts = None
+        # layers up to store_max_res x store_max_res are stored, 32 avoids the memory of the 64x64 self attention.
+        # 64 (or None) keeps those too, for show_self_attention_comp at 64, best with store_dtype=torch.float16
+        self.store_max_res = store_max_res
 
 
 class AttentionControlEdit(AttentionStore, abc.ABC):
 
     def step_callback(self, x_t):
         if self.local_blend is not None:
-            x_t = self.local_blend(x_t, self.attention_store)
+            x_t = self.local_blend(x_t, self.local_blend_state)
         return x_t
 
+    def scratch(self, name: str, like: torch.Tensor) -> torch.Tensor:
+        # one buffer per name and shape, reused by every layer and step of that shape
+        key = (name, like.shape, like.dtype, like.device)
+        if key not in self.scratch_buffers:
+            self.scratch_buffers[key] = torch.empty_like(like)
+        return self.scratch_buffers[key]
+
     def replace_self_attention(self, attn_base, att_replace):
         if att_replace.shape[2] <= 16 ** 2:
             return attn_base.unsqueeze(0).expand(att_replace.shape[0], *attn_base.shape)
         else:
             return att_replace
 
+    def replace_self_attention_(self, attn_base, att_replace):
+        # replace_self_attention written into att_replace. the default returns a view, nothing is allocated
+        replaced = self.replace_self_attention(attn_base, att_replace)
+        if replaced.data_ptr() != att_replace.data_ptr():
+            att_replace.copy_(replaced)
+
     @abc.abstractmethod
     def replace_cross_attention(self, attn_base, att_replace):
         raise NotImplementedError
 
+    def replace_cross_attention_(self, attn_base, att_replace, out):
+        # replace_cross_attention written into out, which may be att_replace itself. subclasses override it to
+        # skip the temporary
+        out.copy_(self.replace_cross_attention(attn_base, att_replace))
+
+    def edit_cross_attention_(self, attn_base, att_replace):
+        # the edit blended into att_replace word by word with the cross replace schedule. the schedule is 0 / 1
+        # and lerp is exact at both ends, steps that replace every word skip the blend
+        if self.cross_replace_modes[self.cur_step] == "full":
+            self.replace_cross_attention_(attn_base, att_replace, att_replace)
+        else:
+            edited = self.scratch("edited", att_replace)
+            self.replace_cross_attention_(attn_base, att_replace, edited)
+            att_replace.lerp_(edited, self.cross_replace_alpha[self.cur_step])
+
+    def store_specs(self):
+        if self.store_attention:
+            return super(AttentionControlEdit, self).store_specs()
+        return []
+
+    def attention_specs(self):
+        # self attention is only replaced up to 16x16, cross attention everywhere
+        specs = self.store_specs() + [ptp_utils.LayerSpec(is_cross=True, steps=self.cross_replace_window),
+                                      ptp_utils.LayerSpec(is_cross=False, max_res=16, steps=self.num_self_replace)]
+        if self.local_blend is not None:
+            specs += self.local_blend.attention_specs()
+        return specs
+
     def forward(self, attn, is_cross: bool, place_in_unet: str):
-        super(AttentionControlEdit, self).forward(attn, is_cross, place_in_unet)
-        if is_cross or (self.num_self_replace[0] <= self.cur_step < self.num_self_replace[1]):
+        if is_cross:
+            do_replace = self.cross_replace_modes[self.cur_step] != "skip"
+        else:
+            do_replace = self.num_self_replace[0] <= self.cur_step < self.num_self_replace[1]
+        if do_replace:
             h = attn.shape[0] // (self.batch_size)
             attn = attn.reshape(self.batch_size, h, *attn.shape[1:])
             attn_base, attn_repalce = attn[0], attn[1:]
+            # both edits write into the edited prompts' rows of attn
             if is_cross:
-                alpha_words = self.cross_replace_alpha[self.cur_step]
-                attn_repalce_new = self.replace_cross_attention(attn_base, attn_repalce) * alpha_words + (
-                            1 - alpha_words) * attn_repalce
-                attn[1:] = attn_repalce_new
+                self.edit_cross_attention_(attn_base, attn_repalce)
             else:
-                attn[1:] = self.replace_self_attention(attn_base, attn_repalce)
+                self.replace_self_attention_(attn_base, attn_repalce)
             attn = attn.reshape(self.batch_size * h, *attn.shape[2:])
-        return attn
+        # the store and the local blend see the edited maps
+        if self.local_blend is not None:
+            self.local_blend.accumulate(attn, is_cross, place_in_unet, self.local_blend_state)
+        return super(AttentionControlEdit, self).forward(attn, is_cross, place_in_unet)
+
+    def reset(self):
+        super(AttentionControlEdit, self).reset()
+        self.scratch_buffers = {}
+        self.local_blend_state = LocalBlendState()
 
     def __init__(self, prompts, num_steps: int,
                  cross_replace_steps: Union[float, Tuple[float, float], Dict[str, Tuple[float, float]]],
                  self_replace_steps: Union[float, Tuple[float, float]],
-                 local_blend: Optional[LocalBlend]):
-        super(AttentionControlEdit, self).__init__()
-        self.batch_size = len(prompts)
-        self.cross_replace_alpha = ptp_utils.get_time_words_attention_alpha(prompts, num_steps, cross_replace_steps,
-                                                                            tokenizer).to(device)
+                 local_blend: Optional[LocalBlend], store_attention: bool = True,
+                 store_dtype: Optional[torch.dtype] = None, store_max_res: Optional[int] = 32):
+        super(AttentionControlEdit, self).__init__(store_dtype, batch_size=len(prompts), store_max_res=store_max_res)
+        self.scratch_buffers = {}
+        cross_replace_alpha = ptp_utils.get_time_words_attention_alpha(prompts, num_steps, cross_replace_steps,
+                                                                       tokenizer)
+        # per step on the host: "skip" when no word is edited, "full" when all of them are, "partial" otherwise
+        alpha_steps = cross_replace_alpha.reshape(num_steps + 1, -1)
+        self.cross_replace_modes = ["skip" if off else "full" if on else "partial"
+                                    for on, off in zip(alpha_steps.eq(1).all(1).tolist(),
+                                                       alpha_steps.eq(0).all(1).tolist())]
+        # steps in which some word is still edited, outside of them cross attention is left as is
+        cross_steps = [step for step, mode in enumerate(self.cross_replace_modes) if mode != "skip"]
+        self.cross_replace_window = (cross_steps[0], cross_steps[-1] + 1) if cross_steps else (0, 0)
+        self.cross_replace_alpha = cross_replace_alpha.to(device)
         if type(self_replace_steps) is float:
             self_replace_steps = 0, self_replace_steps
         self.num_self_replace = int(num_steps * self_replace_steps[0]), int(num_steps * self_replace_steps[1])
         self.local_blend = local_blend
+        self.local_blend_state = LocalBlendState()
+        # False stores nothing, show_cross_attention / aggregate_attention won't work
+        self.store_attention = store_attention
+
+
+class ReplacementMapping:
+    # the token mapping of a replacement edit. the mapper is almost always the identity or a permutation: every
+    # target token copies one source with a single gather, the few targets mixed from several sources (or none)
+    # are redone with scatter_add_
+    alphas = None
+
+    def __call__(self, attn_base, batch_size: int):
+        # (heads, pixels, tokens) source maps -> (batch, heads, pixels, tokens) maps of the edited prompts
+        if self.is_identity:
+            return attn_base.unsqueeze(0).expand(batch_size, *attn_base.shape)
+        return self.map_into(attn_base, attn_base.new_empty(batch_size, *attn_base.shape))
+
+    def map_into(self, attn_base, out):
+        if self.is_identity:
+            return out.copy_(attn_base)
+        attn_base = attn_base.unsqueeze(0).expand_as(out)
+        torch.gather(attn_base, -1, self.inds[:, None, None, :].expand_as(out), out=out)
+        for i, (mixed, target, source, weights) in self.mixed:
+            out[i].index_fill_(-1, mixed, 0)
+            out[i].scatter_add_(-1, target.expand(*out.shape[1:-1], -1),
+                                attn_base[i].gather(-1, source.expand(*out.shape[1:-1], -1)) * weights)
+        return out
+
+    def __init__(self, prompts):
+        inds, weights = seq_aligner.get_compact_mapper(seq_aligner.get_replacement_mapper(prompts, tokenizer))
+        num_tokens = inds.shape[1]
+        # the first source of every target token, and per edit the targets that are not a plain copy of it with
+        # all of their weighted sources
+        self.inds = inds[:, :, 0].to(device)
+        self.mixed = []
+        for i, (inds_, weights_) in enumerate(zip(inds, weights)):
+            mixed = weights_[:, 0].ne(1) | weights_[:, 1:].ne(0).any(-1)
+            if mixed.any():
+                sources = mixed.unsqueeze(-1) & weights_.ne(0)
+                targets = torch.arange(num_tokens).unsqueeze(-1).expand_as(inds_)
+                self.mixed.append((i, (mixed.nonzero()[:, 0].to(device), targets[sources].to(device),
+                                       inds_[sources].to(device), weights_[sources].to(device))))
+        self.is_identity = not self.mixed and bool(inds[:, :, 0].eq(torch.arange(num_tokens)).all())
+
+
+class RefinementMapping:
+    # the token mapping of a refinement edit, alphas is 0 for the tokens that only the edited prompts have
+
+    def __call__(self, attn_base, batch_size: int):
+        return attn_base[:, :, self.mapper].permute(2, 0, 1, 3)
+
+    def map_into(self, attn_base, out):
+        return torch.gather(attn_base.unsqueeze(0).expand_as(out), -1, self.inds[:, None, None, :].expand_as(out),
+                            out=out)
+
+    def __init__(self, prompts):
+        self.mapper, alphas = seq_aligner.get_refinement_mapper(prompts, tokenizer, device=device)
+        self.alphas = alphas.reshape(alphas.shape[0], 1, 1, alphas.shape[1])
+        # unaligned tokens are -1 in the mapper, wrapped around like the indexing in __call__ does
+        self.inds = self.mapper % self.mapper.shape[1]
 
 
 class AttentionReplace(AttentionControlEdit):
 
     def replace_cross_attention(self, attn_base, att_replace):
-        # if self.mapper.shape[0] == 1 and (self.mapper[0] - torch.eye(77).to("cuda")).sum() < 1e-6:
-        #     # print("weird, einsum redundant, it basically do attn_base[None, :]")
-        #     print()
-        #
-        # else:
-        #     print("normal i think")
+        return self.mapping(attn_base, att_replace.shape[0])
 
-        return torch.einsum('hpw,bwn->bhpn', attn_base, self.mapper)
+    def replace_cross_attention_(self, attn_base, att_replace, out):
+        self.mapping.map_into(attn_base, out)
 
     def __init__(self, prompts, num_steps: int, cross_replace_steps: float, self_replace_steps: float,
-                 local_blend: Optional[LocalBlend] = None):
-        super(AttentionReplace, self).__init__(prompts, num_steps, cross_replace_steps, self_replace_steps, local_blend)
-        self.mapper = seq_aligner.get_replacement_mapper(prompts, tokenizer).to(device)
+                 local_blend: Optional[LocalBlend] = None, store_attention: bool = True,
+                 store_dtype: Optional[torch.dtype] = None, store_max_res: Optional[int] = 32):
+        super(AttentionReplace, self).__init__(prompts, num_steps, cross_replace_steps, self_replace_steps, local_blend,
+                                               store_attention, store_dtype, store_max_res)
+        self.mapping = ReplacementMapping(prompts)
 
 
 class AttentionRefine(AttentionControlEdit):
 
     def replace_cross_attention(self, attn_base, att_replace):
-        attn_base_replace = attn_base[:, :, self.mapper].permute(2, 0, 1, 3)
-        attn_replace = attn_base_replace * self.alphas + att_replace * (1 - self.alphas)
+        attn_base_replace = self.mapping(attn_base, att_replace.shape[0])
+        attn_replace = attn_base_replace * self.mapping.alphas + att_replace * (1 - self.mapping.alphas)
         return attn_replace
 
+    def replace_cross_attention_(self, attn_base, att_replace, out):
+        # the alphas are 0 / 1, lerp gives the same as the blend above
+        mapped = self.mapping.map_into(attn_base, self.scratch("mapped", att_replace))
+        torch.lerp(att_replace, mapped, self.mapping.alphas, out=out)
+
     def __init__(self, prompts, num_steps: int, cross_replace_steps: float, self_replace_steps: float,
-                 local_blend: Optional[LocalBlend] = None):
-        super(AttentionRefine, self).__init__(prompts, num_steps, cross_replace_steps, self_replace_steps, local_blend)
-        self.mapper, alphas = seq_aligner.get_refinement_mapper(prompts, tokenizer)
-        self.mapper, alphas = self.mapper.to(device), alphas.to(device)
-        self.alphas = alphas.reshape(alphas.shape[0], 1, 1, alphas.shape[1])
+                 local_blend: Optional[LocalBlend] = None, store_attention: bool = True,
+                 store_dtype: Optional[torch.dtype] = None, store_max_res: Optional[int] = 32):
+        super(AttentionRefine, self).__init__(prompts, num_steps, cross_replace_steps, self_replace_steps, local_blend,
+                                              store_attention, store_dtype, store_max_res)
+        self.mapping = RefinementMapping(prompts)
 
 
 class AttentionReweight(AttentionControlEdit):
@@ -240,14 +479,170 @@ class AttentionReweight(AttentionControlEdit):
         attn_replace = attn_base[None, :, :, :] * self.equalizer[:, None, None, :]
         return attn_replace
 
+    def replace_cross_attention_(self, attn_base, att_replace, out):
+        if self.prev_controller is not None:
+            self.prev_controller.replace_cross_attention_(attn_base, att_replace, out)
+            out.mul_(self.equalizer[:, None, None, :])
+        else:
+            torch.mul(attn_base.expand_as(out), self.equalizer[:, None, None, :], out=out)
+
     def __init__(self, prompts, num_steps: int, cross_replace_steps: float, self_replace_steps: float, equalizer,
-                 local_blend: Optional[LocalBlend] = None, controller: Optional[AttentionControlEdit] = None):
+                 local_blend: Optional[LocalBlend] = None, controller: Optional[AttentionControlEdit] = None,
+                 store_attention: bool = True, store_dtype: Optional[torch.dtype] = None,
+                 store_max_res: Optional[int] = 32):
         super(AttentionReweight, self).__init__(prompts, num_steps, cross_replace_steps, self_replace_steps,
-                                                local_blend)
+                                                local_blend, store_attention, store_dtype, store_max_res)
         self.equalizer = equalizer.to(device)
         self.prev_controller = controller
 
 
+class AttentionComposedEdit(AttentionControlEdit):
+    # a replace or refine edit re-weighted by an equalizer in one controller and one pass. with alpha_w the cross
+    # replace schedule, a the refinement alphas (1 for replace) and eq the equalizer, the chained
+    # AttentionReweight(controller=...) edit
+    #   alpha_w * eq * (a * mapped + (1 - a) * replace) + (1 - alpha_w) * replace
+    # is precomputed per step as mapped * coef_mapped + replace * coef_replace
+
+    def replace_cross_attention(self, attn_base, att_replace):
+        # the edit without the alpha_w schedule, as AttentionReweight(controller=...) computes it
+        alphas = 1 if self.mapping.alphas is None else self.mapping.alphas
+        attn_replace = self.mapping(attn_base, att_replace.shape[0]) * alphas + att_replace * (1 - alphas)
+        return attn_replace * self.equalizer
+
+    def edit_cross_attention_(self, attn_base, att_replace):
+        if not self.keeps_replace[self.cur_step]:
+            mapped = self.mapping.map_into(attn_base, att_replace)
+            mapped.mul_(self.coef_mapped[self.cur_step])
+        else:
+            mapped = self.mapping.map_into(attn_base, self.scratch("mapped", att_replace))
+            att_replace.mul_(self.coef_replace[self.cur_step]).addcmul_(mapped, self.coef_mapped[self.cur_step])
+
+    def __init__(self, prompts, num_steps: int, cross_replace_steps: float, self_replace_steps: float,
+                 is_replace: bool, equalizer: Optional[torch.Tensor] = None, local_blend: Optional[LocalBlend] = None,
+                 store_attention: bool = True, store_dtype: Optional[torch.dtype] = None,
+                 store_max_res: Optional[int] = 32):
+        super(AttentionComposedEdit, self).__init__(prompts, num_steps, cross_replace_steps, self_replace_steps,
+                                                    local_blend, store_attention, store_dtype, store_max_res)
+        self.mapping = ReplacementMapping(prompts) if is_replace else RefinementMapping(prompts)
+        self.equalizer = 1 if equalizer is None else equalizer.to(device)[:, None, None, :]
+        alphas = 1 if self.mapping.alphas is None else self.mapping.alphas
+        alpha_words = self.cross_replace_alpha
+        self.coef_mapped = alpha_words * self.equalizer * alphas
+        self.coef_replace = alpha_words * self.equalizer * (1 - alphas) + (1 - alpha_words)
+        # False for the steps that fully replace with a replacement mapping, the edited prompts' maps drop out
+        self.keeps_replace = self.coef_replace.reshape(num_steps + 1, -1).ne(0).any(1).tolist()
+
+
+class BatchedEditControl(AttentionControl):
+    # several independent edits packed in one UNet batch, every controller keeps its own state
+    # and sees only its own rows (controller.batch_size rows each, in order)
+
+    def step_callback(self, x_t):
+        return torch.cat([controller.step_callback(x_t[start: end])
+                          for controller, (start, end) in zip(self.controllers, self.rows)])
+
+    def between_steps(self):
+        for controller in self.controllers:
+            controller.cur_step = self.cur_step
+            controller.between_steps()
+
+    def attention_specs(self):
+        return [spec for controller in self.controllers for spec in controller.attention_specs()]
+
+    def forward(self, attn, is_cross: bool, place_in_unet: str):
+        h = attn.shape[0] // self.rows[-1][1]
+        for controller, (start, end) in zip(self.controllers, self.rows):
+            controller.cur_att_layer = self.cur_att_layer
+            if controller.needs_attention(is_cross, place_in_unet, attn.shape[1]):
+                attn_ = attn[start * h: end * h]
+                attn_new = controller.forward(attn_, is_cross, place_in_unet)
+                if attn_new.data_ptr() != attn_.data_ptr():
+                    attn_.copy_(attn_new)
+        return attn
+
+    def reset(self):
+        super(BatchedEditControl, self).reset()
+        for controller in self.controllers:
+            controller.reset()
+
+    def __init__(self, controllers: List[AttentionControlEdit]):
+        super(BatchedEditControl, self).__init__()
+        self.controllers = controllers
+        ends = list(itertools.accumulate(controller.batch_size for controller in controllers))
+        self.rows = list(zip([0] + ends[:-1], ends))
+
+
+class SourceRecorder(AttentionControl):
+    # runs the source prompt alone and keeps what its edits need later on: the attention maps of the
+    # declared layers and the latents after every step
+
+    def step_callback(self, x_t):
+        self.latents.append(x_t.to(self.cache_device or x_t.device, copy=True))
+        return x_t
+
+    def attention_specs(self):
+        return self.specs
+
+    def forward(self, attn, is_cross: bool, place_in_unet: str):
+        self.attention_maps[(self.cur_step, self.cur_att_layer)] = attn.to(
+            device=self.cache_device or attn.device, dtype=self.cache_dtype or attn.dtype, copy=True)
+        return attn
+
+    def get_attention(self, step: int, layer: int):
+        if (step, layer) not in self.attention_maps:
+            raise KeyError(f"no source attention recorded for step {step}, layer {layer}, "
+                           f"record the source with the attention_specs of all of its edits")
+        return self.attention_maps[(step, layer)]
+
+    def reset(self):
+        super(SourceRecorder, self).reset()
+        self.attention_maps = {}
+        self.latents = []
+
+    def __init__(self, specs: List[ptp_utils.LayerSpec], cache_device=None, cache_dtype: Optional[torch.dtype] = None):
+        super(SourceRecorder, self).__init__()
+        self.specs = specs
+        self.cache_device = cache_device
+        self.cache_dtype = cache_dtype
+        self.attention_maps = {}
+        self.latents = []
+
+
+class SharedSourceControl(BatchedEditControl):
+    # edits of a recorded source: the UNet batch holds only the edited rows (controller.batch_size - 1 rows
+    # each), row 0 of every controller is put back from the recording
+
+    def step_callback(self, x_t):
+        x_source = self.source.latents[self.num_steps_done].to(x_t.device, x_t.dtype)
+        self.num_steps_done += 1
+        return torch.cat([controller.step_callback(torch.cat([x_source, x_t[start: end]]))[1:]
+                          for controller, (start, end) in zip(self.controllers, self.rows)])
+
+    def forward(self, attn, is_cross: bool, place_in_unet: str):
+        h = attn.shape[0] // self.rows[-1][1]
+        attn_base = None
+        for controller, (start, end) in zip(self.controllers, self.rows):
+            controller.cur_att_layer = self.cur_att_layer
+            if controller.needs_attention(is_cross, place_in_unet, attn.shape[1]):
+                if attn_base is None:
+                    attn_base = self.source.get_attention(self.cur_step, self.cur_att_layer).to(attn.device,
+                                                                                                attn.dtype)
+                attn_ = torch.cat([attn_base, attn[start * h: end * h]])
+                attn[start * h: end * h] = controller.forward(attn_, is_cross, place_in_unet)[attn_base.shape[0]:]
+        return attn
+
+    def reset(self):
+        super(SharedSourceControl, self).reset()
+        self.num_steps_done = 0
+
+    def __init__(self, controllers: List[AttentionControlEdit], source: SourceRecorder):
+        super(SharedSourceControl, self).__init__(controllers)
+        ends = list(itertools.accumulate(controller.batch_size - 1 for controller in controllers))
+        self.rows = list(zip([0] + ends[:-1], ends))
+        self.source = source
+        self.num_steps_done = 0
+
+
 def get_equalizer(text: str, word_select: Union[int, Tuple[int, ...]], values: Union[List[float],
                                                                                      Tuple[float, ...]]):
     if type(word_select) is int or type(word_select) is str:
@@ -264,56 +659,55 @@ from PIL import Image
 
 
 def aggregate_attention(attention_store: AttentionStore, res: int, from_where: List[str], is_cross: bool, select: int):
-    out = []
-    attention_maps = attention_store.get_average_attention()
-    num_pixels = res ** 2
-    for location in from_where:
-        for item in attention_maps[f"{location}_{'cross' if is_cross else 'self'}"]:
-            if item.shape[1] == num_pixels:
-                cross_maps = item.reshape(len(prompts), -1, res, res, item.shape[-1])[select]
-                out.append(cross_maps)
-    out = torch.cat(out, dim=0)
-    out = out.sum(0) / out.shape[0]
-    return out.cpu()
-
-
-def show_cross_attention(attention_store: AttentionStore, res: int, from_where: List[str], select: int = 0, name=""):
-    tokens = tokenizer.encode(prompts[select])
-    decoder = tokenizer.decode
-    attention_maps = aggregate_attention(attention_store, res, from_where, True, select)
-    images = []
-    for i in range(len(tokens)):
-        image = attention_maps[:, :, i]
-        image = 255 * image / image.max()
-        image = image.unsqueeze(-1).expand(*image.shape, 3)
-        image = image.numpy().astype(np.uint8)
-        image = np.array(Image.fromarray(image).resize((256, 256)))
-        image = ptp_utils.text_under_image(image, decoder(int(tokens[i])))
-        images.append(image)
-        # plt.imshow(image)
-        # plt.show()
-    ptp_utils.view_images(np.stack(images, axis=0), title=name)
-
-    # Image.fromarray(np.stack(images, axis=0)).save(f"{name}")
-
-
+    # a copy, the store's cached aggregate is shared by all callers
+    return attention_store.aggregate(res, from_where, is_cross)[select].to("cpu", copy=True)
+
+
+def show_cross_attention(attention_store: AttentionStore, res: int, from_where: List[str],
+                         select: Optional[int] = 0, name="", size: int = 256, prompts: Optional[List[str]] = None):
+    # select=None shows all prompts of the batch, one row each. the maps of all tokens are normalised and
+    # resized in one batched op, the token labels come from ptp_utils.text_band. prompts defaults to the ones
+    # the store last ran with
+    if prompts is None:
+        prompts = attention_store.prompts
+    if prompts is None:
+        raise ValueError("the prompts are unknown, run the store through a text2image call first or pass them")
+    selected = list(range(attention_store.batch_size)) if select is None else [select]
+    token_ids = [seq_aligner.analyze_prompt(prompts[i], tokenizer).token_ids for i in selected]
+    num_tokens = max(len(tokens) for tokens in token_ids)
+    attention_maps = attention_store.aggregate(res, from_where, True)[selected, :, :, :num_tokens]
+    attention_maps = attention_maps.permute(0, 3, 1, 2).float()
+    attention_maps = (255 * attention_maps / attention_maps.amax(dim=(2, 3), keepdim=True)).floor_()
+    attention_maps = ptp_utils.resize_images(attention_maps, (size, size)).cpu().numpy()
+    offset = int(size * .2)
+    images = np.full((len(selected), num_tokens, size + offset, size, 3), 255, dtype=np.uint8)
+    for row, tokens in enumerate(token_ids):
+        images[row, :len(tokens), :size] = attention_maps[row, :len(tokens), :, :, None]
+        images[row, :len(tokens), size:] = [ptp_utils.text_band(tokenizer.decode(int(token)), size, size)
+                                            for token in tokens]
+    ptp_utils.view_images(images.reshape(-1, size + offset, size, 3), num_rows=len(selected), title=name)
 
 
 def show_self_attention_comp(attention_store: AttentionStore, res: int, from_where: List[str],
-                             max_com=10, select: int = 0):
-    attention_maps = aggregate_attention(attention_store, res, from_where, False, select).numpy().reshape(
-        (res ** 2, res ** 2))
-    u, s, vh = np.linalg.svd(attention_maps - np.mean(attention_maps, axis=1, keepdims=True))
-    images = []
-    for i in range(max_com):
-        image = vh[i].reshape(res, res)
-        image = image - image.min()
-        image = 255 * image / image.max()
-        image = np.repeat(np.expand_dims(image, axis=2), 3, axis=2).astype(np.uint8)
-        image = Image.fromarray(image).resize((256, 256))
-        image = np.array(image)
-        images.append(image)
-    ptp_utils.view_images(np.concatenate(images, axis=1))
+                             max_com=10, select: Optional[int] = 0, size: int = 256, niter: int = 4):
+    # the first max_com principal components of the self-attention maps, from a randomised truncated SVD on the
+    # store's device instead of a full one. select=None shows all prompts of the batch, one row each
+    selected = list(range(attention_store.batch_size)) if select is None else [select]
+    attention_maps = attention_store.aggregate(res, from_where, False)[selected].float()
+    attention_maps = attention_maps.reshape(len(selected), res ** 2, res ** 2)
+    attention_maps = attention_maps - attention_maps.mean(dim=2, keepdim=True)
+    # svd_lowrank draws its random projection from the global generator, keep it out of the sampling stream.
+    # manual_seed reseeds every CUDA device, all of them are forked whatever device the maps are on
+    devices = list(range(torch.cuda.device_count())) if torch.cuda.is_available() else []
+    with torch.random.fork_rng(devices=devices):
+        torch.manual_seed(0)
+        _, _, v = torch.svd_lowrank(attention_maps, q=min(max_com + 10, res ** 2), niter=niter)
+    images = v[:, :, :max_com].transpose(1, 2).reshape(len(selected), max_com, res, res)
+    images = images - images.amin(dim=(2, 3), keepdim=True)
+    images = (255 * images / images.amax(dim=(2, 3), keepdim=True)).floor_()
+    images = ptp_utils.resize_images(images, (size, size)).cpu().numpy()
+    images = np.repeat(images.transpose(0, 2, 1, 3).reshape(len(selected), size, max_com * size, 1), 3, axis=3)
+    ptp_utils.view_images(images, num_rows=len(selected))
 
 
 def run_and_display(prompts, controller, latent=None, run_baseline=False, generator=None):
@@ -361,6 +755,112 @@ def run_and_display(prompts, controller, latent=None, run_baseline=False, genera
 # _ = run_and_display(prompts, controller, latent=x_t, run_baseline=False)
 
 
+class SweepJob(NamedTuple):
+    # one (source, edit) pair of a sweep, re-weighting eq_words of the source prompt by weight
+    prompts: Tuple[str, str]
+    seed: int
+    weight: float
+    eq_words: Tuple[str, ...]
+    cross_replace_steps: float
+    guidance_scale: float
+    self_replace_steps: float = .2
+    # the latent is the draw-th (from 0) normal draw of a generator seeded with seed
+    draw: int = 0
+
+
+def make_sweep_jobs(prompts_list: List[Tuple[str, str]], seeds: List[int], weights: List[float],
+                    eq_words: Tuple[str, ...], cross_replace_steps: List[float] = (.8,),
+                    guidance_scales: List[float] = (GUIDANCE_SCALE,), self_replace_steps: float = .2) -> List[SweepJob]:
+    return [SweepJob(tuple(prompts), seed, weight, tuple(eq_words), cross_replace_vals, gc, self_replace_steps)
+            for gc, cross_replace_vals, seed, prompts, weight in
+            itertools.product(guidance_scales, cross_replace_steps, seeds, prompts_list, weights)]
+
+
+def job_controller(job: SweepJob) -> AttentionControlEdit:
+    equalizer = get_equalizer(job.prompts[0], job.eq_words, (job.weight,))
+    return AttentionReweight(list(job.prompts), NUM_DIFFUSION_STEPS,
+                             cross_replace_steps={"default_": job.cross_replace_steps},
+                             self_replace_steps=job.self_replace_steps, equalizer=equalizer, store_attention=False)
+
+
+def job_generator(job: SweepJob) -> torch.Generator:
+    # the generator job_latent draws from, seeded with job.seed and past its first job.draw draws
+    generator = torch.Generator().manual_seed(job.seed)
+    for _ in range(job.draw):
+        torch.randn((1, ldm_stable.unet.in_channels, 512 // 8, 512 // 8), generator=generator)
+    return generator
+
+
+def job_latent(job: SweepJob) -> torch.Tensor:
+    # jobs with the same seed and draw start from the same noise
+    return torch.randn((1, ldm_stable.unet.in_channels, 512 // 8, 512 // 8), generator=job_generator(job))
+
+
+def run_sweep(jobs: List[SweepJob], pairs_per_batch: int = 4, share_source: bool = False,
+              source_cache_dtype: Optional[torch.dtype] = None,
+              is_done: Optional[Callable[[SweepJob], bool]] = None) -> Iterator[Tuple[SweepJob, np.ndarray]]:
+    # packs up to pairs_per_batch jobs in one UNet batch, yields (job, [source image, edited image]).
+    # with share_source the source of every (source prompt, seed, guidance scale) is generated once and
+    # only the edited rows go through the UNet, the jobs then come out grouped by their source.
+    # the source's attention maps of all steps stay on the GPU meanwhile, 2.5-2.8GB per source as computed
+    # (float32), and the images match the joint batches. source_cache_dtype=torch.float16 halves that, at the
+    # price of edits injected from rounded maps: images then differ from the joint batches by a grey level or so.
+    # the batches are always cut from the full jobs list, results vary slightly with the batch they are run
+    # in. jobs is_done says are finished are not yielded, a batch of only finished jobs is skipped and a
+    # batch with any job left is run whole, so a resumed sweep gives the images of an uninterrupted one
+    # is_done is asked once up front, the jobs yielded below get recorded as done while the sweep runs
+    finished = set() if is_done is None else {job for job in jobs if is_done(job)}
+    is_done = finished.__contains__
+    if share_source:
+        yield from run_sweep_shared_source(jobs, pairs_per_batch, source_cache_dtype, is_done)
+        return
+    for i in range(0, len(jobs), pairs_per_batch):
+        batch = jobs[i: i + pairs_per_batch]
+        if all(is_done(job) for job in batch):
+            continue
+        controller = BatchedEditControl([job_controller(job) for job in batch])
+        prompts = [prompt for job in batch for prompt in job.prompts]
+        latent = torch.cat([job_latent(job).expand(len(job.prompts), -1, -1, -1) for job in batch])
+        guidance_scale = torch.tensor([job.guidance_scale for job in batch for _ in job.prompts],
+                                      device=ldm_stable.device).reshape(-1, 1, 1, 1)
+        images, _ = ptp_utils.text2image_ldm_stable(ldm_stable, prompts, controller, latent=latent,
+                                                    num_inference_steps=NUM_DIFFUSION_STEPS,
+                                                    guidance_scale=guidance_scale, low_resource=LOW_RESOURCE)
+        for k, job in enumerate(batch):
+            if not is_done(job):
+                yield job, images[2 * k: 2 * k + 2]
+
+
+def run_sweep_shared_source(jobs: List[SweepJob], pairs_per_batch: int = 4,
+                            source_cache_dtype: Optional[torch.dtype] = None,
+                            is_done: Callable[[SweepJob], bool] = lambda job: False):
+    groups = {}
+    for job in jobs:
+        groups.setdefault((job.prompts[0], job.seed, job.draw, job.guidance_scale), []).append(job)
+    for (source_prompt, seed, draw, guidance_scale), group in groups.items():
+        if all(is_done(job) for job in group):
+            continue
+        controllers = [job_controller(job) for job in group]
+        source = SourceRecorder([spec for controller in controllers for spec in controller.attention_specs()],
+                                cache_dtype=source_cache_dtype)
+        latent = job_latent(group[0])
+        source_image, _ = ptp_utils.text2image_ldm_stable(ldm_stable, [source_prompt], source, latent=latent,
+                                                          num_inference_steps=NUM_DIFFUSION_STEPS,
+                                                          guidance_scale=guidance_scale, low_resource=LOW_RESOURCE)
+        for i in range(0, len(group), pairs_per_batch):
+            batch = group[i: i + pairs_per_batch]
+            if all(is_done(job) for job in batch):
+                continue
+            controller = SharedSourceControl(controllers[i: i + pairs_per_batch], source)
+            prompts = [prompt for job in batch for prompt in job.prompts[1:]]
+            images, _ = ptp_utils.text2image_ldm_stable(ldm_stable, prompts, controller, latent=latent,
+                                                        num_inference_steps=NUM_DIFFUSION_STEPS,
+                                                        guidance_scale=guidance_scale, low_resource=LOW_RESOURCE)
+            for k, job in enumerate(batch):
+                if not is_done(job):
+                    yield job, np.stack([source_image[0], images[k]])
+
+
 def set_seed(seed: int = 42) -> None:
     np.random.seed(seed)
     random.seed(seed)
@@ -420,145 +920,100 @@ seed = 8888
 
 
 
-def general_generation_exp_pipe(seeds_arr, weights_arr):
-    global GUIDANCE_SCALE
-    # cross_replace_vals = 0.7
-    for gc in [5, 7.5, 10, 15]:
-        GUIDANCE_SCALE = gc
-        for cross_replace_vals in [0.6, 0.8, 0.9]:
-            for seed in seeds_arr:  # list(range(8, 100)):
-                x_1 = None
-                start_with_no_makeup = []
-
-                start_with_makeup = []
-                folder = f"reweight/{seed}_{cross_replace_vals}_{gc}_mask"
-                if not os.path.exists(f"/cnvrg/{folder}"):
-                    os.mkdir(f"/cnvrg/{folder}")
-
-                diff_folder = f"{folder}/diff"
-                if not os.path.exists(f"/cnvrg/{diff_folder}"):
-                    os.mkdir(f"/cnvrg/{diff_folder}")
-                g_cpu = torch.Generator().manual_seed(seed)
-
-                for weight in weights_arr:  # , 0.6, 1, 3, 6, 10, 20, 50, 150]:
-                    print(f"weight - {weight}")
-                    prompts = [
-                        "close up face shot of a woman , beautiful, classic",
-                        "close up face shot of a woman wearing an elegant venetian mask, beautiful, classic"]
-                    if x_1 is not None:
-                        g_cpu.set_state(x_1)
-
-                    equalizer = get_equalizer(prompts[0], ("mask",), (weight,))
-                    print(equalizer[equalizer != 1])
-
-                    controller = AttentionReweight(prompts, NUM_DIFFUSION_STEPS,
-                                                   cross_replace_steps={"default_": cross_replace_vals},
-                                                   self_replace_steps=.2, local_blend=None, equalizer=equalizer)
-
-                    image, x_t = run_and_display(prompts, controller, latent=None, generator=g_cpu)
-                    # show_cross_attention(controller, res=16, from_where=("up", "down"), name=f"{folder}/croos_attn_{seed}_w_o_local_blend_{weight}")
-
-                    # Image.fromarray(np.hstack((image[0], image[1]))).save(f"/cnvrg/{folder}/{seed}_w_o_local_blend_{weight}.jpg")
-                    # Image.fromarray(image[0]).save(f"/cnvrg/{folder}/{seed}_0_w_o_local_blend_{weight}.jpg")
-                    if x_1 is not None and len(start_with_no_makeup) == 0:
-                        diff = np.abs((image[1].astype("float32") - image[0].astype("float32"))).astype("uint8")
-                        Image.fromarray(diff).save(f"{diff_folder}/diff_makeup_weight_{weight}.png")
-                        im = np.vstack([image[0], diff])
-                        start_with_no_makeup.append(im)
-                        Image.fromarray(image[0]).save(f"{folder}/start_no_makeup.png")
-
-                    # Image.fromarray(image[1]).save(f"/cnvrg/{folder}/{seed}_1_w_o_local_blend_{weight}.jpg")
-                    if x_1 is not None:
-                        diff = np.abs((image[1].astype("float32") - image[0].astype("float32"))).astype("uint8")
-                        Image.fromarray(diff).save(f"{diff_folder}/diff_makeup_weight_{weight}.png")
-                        im = np.vstack([image[1], diff])
-                        start_with_no_makeup.append(im)
-                        Image.fromarray(image[1]).save(f"{folder}/result_no_makeup_weight_{weight}.png")
-
-                    diff = np.abs((image[1].astype("float32") - image[0].astype("float32"))).astype("uint8")
-                    Image.fromarray(diff).save(f"{diff_folder}/diff_no_makeup_weight_{weight}.png")
-
-                    prompts = prompts[::-1]
-
-                    if x_1 is not None:
-                        g_cpu.set_state(x_1)
-                    else:
-                        print("getting x_1")
-                        x_1 = g_cpu.get_state().clone()
-                        continue
-
-                    equalizer = get_equalizer(prompts[0], ("makeup",), (weight,))
-                    print(equalizer[equalizer != 1])
-                    controller = AttentionReweight(prompts, NUM_DIFFUSION_STEPS,
-                                                   cross_replace_steps={"default_": cross_replace_vals},
-                                                   self_replace_steps=.2, local_blend=None, equalizer=equalizer)
-
-                    image, x_t = run_and_display(prompts, controller, latent=None, generator=g_cpu)
-
-                    # Image.fromarray(np.hstack((image[0], image[1]))).save(f"/cnvrg/{folder}/{seed}_w_o_local_blend_reverse_order_of_prompts_{weight}.jpg")
-                    # Image.fromarray(image[0]).save(f"/cnvrg/{folder}/{seed}_0_w_o_local_blend_reverse_order_of_prompts_{weight}.jpg")
-                    if len(start_with_makeup) == 0 and x_1 is not None:
-                        diff = np.abs((image[1].astype("float32") - image[0].astype("float32"))).astype("uint8")
-                        Image.fromarray(diff).save(f"{diff_folder}/diff_makeup_weight_{weight}.png")
-                        im = np.vstack([image[0], diff])
-                        start_with_makeup.append(im)
-                        Image.fromarray(image[0]).save(f"{folder}/start_makeup.png")
-                    # Image.fromarray(image[1]).save(f"/cnvrg/{folder}/{seed}_1_w_o_local_blend_reverse_order_of_prompts_{weight}.jpg")
-
-                    if x_1 is not None:
-                        diff = np.abs((image[1].astype("float32") - image[0].astype("float32"))).astype("uint8")
-                        Image.fromarray(diff).save(f"{diff_folder}/diff_makeup_weight_{weight}.png")
-                        im = np.vstack([image[1], diff])
-                        start_with_makeup.append(im)
-                        Image.fromarray(image[1]).save(f"{folder}/result_makeup_weight_{weight}.png")
-
-                    diff = np.abs((image[1].astype("float32") - image[0].astype("float32"))).astype("uint8")
-                    Image.fromarray(diff).save(f"{diff_folder}/diff_makeup_weight_{weight}.png")
-
-                print(f"len(start with no makeup) = {len(start_with_no_makeup)}")
-                np_im = np.hstack(start_with_no_makeup)
-                im = Image.fromarray(np_im)
-                im.save(f"/cnvrg/{folder}/{seed}_starting_without_makeup.jpg")
-
-                print(f"len(start with makeup) = {len(start_with_makeup)}")
-
-                np_im = np.hstack(start_with_makeup)
-                im = Image.fromarray(np_im)
-                im.save(f"/cnvrg/{folder}/{seed}_starting_with_makeup.jpg")
-                x_1 = None
-
-def choose_couples_by_clip_sim(prompts, seeds, weights, eq_val, max_num_of_images, cross_replace_vals = 0.6):
+def general_generation_exp_pipe(seeds_arr, weights_arr, pairs_per_batch=4, share_source=False,
+                                sink: Optional[io_utils.ImageSink] = None):
+    # share_source=True runs every source once for all its weights, see run_sweep for its GPU memory
+    prompts = ("close up face shot of a woman , beautiful, classic",
+               "close up face shot of a woman wearing an elegant venetian mask, beautiful, classic")
+    # the first weight of every seed used to be a warm-up run: its images were thrown away and the others all
+    # started from the generator's second draw. it is left out, the rest starts from that same draw
+    jobs = [SweepJob(prompts_, seed, weight, (eq_word,), cross_replace_vals, gc, .2, draw=1)
+            for gc in [5, 7.5, 10, 15]
+            for cross_replace_vals in [0.6, 0.8, 0.9]
+            for seed in seeds_arr
+            for prompts_, eq_word in ((prompts, "mask"), (prompts[::-1], "makeup"))
+            for weight in weights_arr[1:]]
+    # finished jobs are in the manifest, a restarted sweep only runs the rest
+    manifest = io_utils.SweepManifest(io_utils.output_path("reweight", "manifest.jsonl"))
+    sink = sink or io_utils.default_sink()
+    strips = {}
+
+    def add_to_strip(job, start, result, diff):
+        folder = io_utils.output_path("reweight", f"{job.seed}_{job.cross_replace_steps}_{job.guidance_scale}_mask")
+        name = "makeup" if job.eq_words == ("makeup",) else "no_makeup"
+        strip = strips.setdefault((folder, name), {})
+        strip[job.weight] = (start, result, diff)
+        if len(strip) == len(weights_arr) - 1:
+            print(f"len(start with {name}) = {len(strip) + 1}")
+            starting = "with_makeup" if name == "makeup" else "without_makeup"
+            del strips[(folder, name)]
+            strip = [strip[weight] for weight in weights_arr[1:]]
+            columns = [np.vstack([strip[0][0], strip[0][2]])] + [np.vstack([result, diff]) for _, result, diff in strip]
+            sink.save(np.hstack(columns), f"{folder}/{job.seed}_starting_{starting}.jpg")
+
+    for job in jobs:
+        if manifest.is_done(job):
+            outputs = manifest.outputs(job)
+            add_to_strip(job, *(io_utils.load_image(outputs[key]) for key in ("start", "result", "diff")))
+    try:
+        for job, image in run_sweep(jobs, pairs_per_batch, share_source, is_done=manifest.is_done):
+            print(f"seed - {job.seed}, weight - {job.weight}")
+            folder = io_utils.output_path("reweight", f"{job.seed}_{job.cross_replace_steps}_{job.guidance_scale}_mask")
+            name = "makeup" if job.eq_words == ("makeup",) else "no_makeup"
+            diff = np.abs((image[1].astype("float32") - image[0].astype("float32"))).astype("uint8")
+            outputs = {"start": f"{folder}/start_{name}.png",
+                       "result": f"{folder}/result_{name}_weight_{job.weight}.png",
+                       "diff": f"{folder}/diff/diff_{name}_weight_{job.weight}.png"}
+            images = {outputs["result"]: image[1], outputs["diff"]: diff}
+            # all weights of a strip share the start image. every job writes it until it is on disk, a job is
+            # only recorded once the start image it lists is written
+            if not os.path.exists(outputs["start"]):
+                images[outputs["start"]] = image[0]
+            add_to_strip(job, image[0], image[1], diff)
+            # the job goes in the manifest once the writer threads have its images on disk
+            sink.save_all(images, functools.partial(manifest.record, job, outputs,
+                                                    io_utils.encode_generator_state(job_generator(job))))
+    finally:
+        # an interrupted sweep still gets its finished images and manifest lines
+        sink.wait()
+    sink.flush()
+
+
+def choose_couples_by_clip_sim(prompts, seeds, weights, eq_val, max_num_of_images, cross_replace_vals = 0.6,
+                               pairs_per_batch=4, sink: Optional[io_utils.ImageSink] = None):
     clip_similarity_metric = ClipSimilarity()
 
-    folder = "/cnvrg/couples/"
+    folder = io_utils.output_path("couples")
+    sink = sink or io_utils.default_sink()
     images_arr =[]
     images_sim_arr = []
-    if not os.path.exists(folder):
-        os.mkdir(folder)
-    for seed in seeds:
-        print(seed)
-        g_cpu = torch.Generator().manual_seed(seed)
-
-        for weight in weights:
-            print(f"weight - {weight}")
-
-            equalizer = get_equalizer(prompts[0], (eq_val,), (weight,))
-            print(equalizer[equalizer != 1])
-
-            controller = AttentionReweight(prompts, NUM_DIFFUSION_STEPS,
-                                           cross_replace_steps={"default_": cross_replace_vals},
-                                           self_replace_steps=.2, local_blend=None, equalizer=equalizer)
-
-            image, x_t = run_and_display(prompts, controller, latent=None, generator=g_cpu)
+    os.makedirs(folder, exist_ok=True)
+    # one generator per seed used to serve all weights in turn, the k-th weight gets the k-th draw
+    jobs = [SweepJob(tuple(prompts), seed, weight, (eq_val,), cross_replace_vals, GUIDANCE_SCALE, .2, draw=draw)
+            for seed in seeds for draw, weight in enumerate(weights)]
+    manifest = io_utils.SweepManifest(f"{folder}/manifest.jsonl")
+    for job in jobs:
+        if manifest.is_done(job):
+            outputs = manifest.outputs(job)
+            images_sim_arr.append(manifest.records[io_utils.job_id(job)]["sim"])
+            images_arr.append((io_utils.load_image(outputs["source"]), io_utils.load_image(outputs["edit"])))
+    try:
+        for job, image in run_sweep(jobs, pairs_per_batch, is_done=manifest.is_done):
+            print(f"seed - {job.seed}, weight - {job.weight}")
+            outputs = {"source": f"{folder}/{job.seed}_{job.weight}_0.png", "edit": f"{folder}/{job.seed}_{job.weight}_1.png"}
             image_1 = Image.fromarray(image[0])
             image_2 = Image.fromarray(image[1])
-            image_1.save(f"{folder}/{seed}_{weight}_0.png")
-            image_2.save(f"{folder}/{seed}_{weight}_1.png")
             _, _, sim, sim_images = clip_similarity_metric(image_1, image_2, [prompts[0]], [prompts[1]])
+            sim = float(sim)
             images_sim_arr.append(sim)
             images_arr.append((image_1, image_2))
+            sink.save_all({outputs["source"]: image[0], outputs["edit"]: image[1]},
+                          functools.partial(manifest.record, job, outputs,
+                                            io_utils.encode_generator_state(job_generator(job)), sim=sim))
             print(f"similarity as i want {sim}")
             print(f"similarity between images {sim_images}")
+    finally:
+        sink.wait()
 
     images_sim_arr = torch.tensor(images_sim_arr)
     sorted_values, indices = images_sim_arr.sort(descending=True)
@@ -569,9 +1024,10 @@ def choose_couples_by_clip_sim(prompts, seeds, weights, eq_val, max_num_of_image
         if i > max_num_of_images:
             break
         images_sorted_arr.append(images_arr[ind])
-    images_sorted_arr = np.hstack(images_sorted_arr)
-    print(images_sorted_arr.shape)
-    Image.fromarray(images_sorted_arr).save(f"{folder}/sorted.png")
+    print((images_sorted_arr[0].shape[0], sum(image.shape[1] for image in images_sorted_arr), 3))
+    # the strip is streamed to disk a band of scanlines at a time instead of being hstacked in memory
+    sink.save_strip(images_sorted_arr, f"{folder}/sorted.png")
+    sink.flush()
 
     print(indices)
     print(sorted_values)
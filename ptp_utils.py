@@ -14,13 +14,19 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
-from PIL import Image, ImageDraw, ImageFont
 import cv2
-from typing import Optional, Union, Tuple, List, Callable, Dict
+from typing import Optional, Union, Tuple, List, Callable, Dict, NamedTuple
 from IPython.display import display
 from tqdm.notebook import tqdm
 import inspect
+import functools
+import hashlib
+import os
+import pickle
+import sys
 import torch.nn.functional as F
+import seq_aligner
+import io_utils
 
 
 def text_under_image(image: np.ndarray, text: str, text_color: Tuple[int, int, int] = (0, 0, 0)):
@@ -36,36 +42,69 @@ def text_under_image(image: np.ndarray, text: str, text_color: Tuple[int, int, i
     return img
 
 
-def view_images(images, num_rows=1, offset_ratio=0.02, title=""):
+@functools.lru_cache(maxsize=4096)
+def text_band(text: str, h: int, w: int, text_color: Tuple[int, int, int] = (0, 0, 0)) -> np.ndarray:
+    # the label band text_under_image puts under an (h, w, 3) image, rendered once per text and size
+    band = text_under_image(np.zeros((h, w, 3), dtype=np.uint8), text, text_color)[h:]
+    band.setflags(write=False)
+    return band
+
+
+@functools.lru_cache(maxsize=64)
+def bicubic_weights(in_size: int, out_size: int) -> np.ndarray:
+    # (out_size, in_size) matrix of PIL's bicubic resampling (a = -0.5) along one axis
+    scale = in_size / out_size
+    filter_scale = max(scale, 1.)
+    support = 2 * filter_scale
+    weights = np.zeros((out_size, in_size))
+    for i in range(out_size):
+        center = (i + .5) * scale
+        lo, hi = max(int(center - support + .5), 0), min(int(center + support + .5), in_size)
+        x = np.abs((np.arange(lo, hi) - center + .5) / filter_scale)
+        k = np.where(x < 1, (1.5 * x - 2.5) * x * x + 1, np.where(x < 2, (((x - 5) * x + 8) * x - 4) * -.5, 0))
+        weights[i, lo: hi] = k / k.sum()
+    return weights
+
+
+def resize_images(images: torch.Tensor, size: Tuple[int, int]) -> torch.Tensor:
+    # batched Image.resize(size[::-1], BICUBIC) of (..., h, w) maps in [0, 255], on the maps' device.
+    # like PIL, the horizontal pass is rounded to uint8 before the vertical one
+    h, w = images.shape[-2:]
+    weights_x = torch.from_numpy(bicubic_weights(w, size[1])).to(images)
+    weights_y = torch.from_numpy(bicubic_weights(h, size[0])).to(images)
+    images = (images @ weights_x.T).add_(.5).floor_().clamp_(0, 255)
+    images = (weights_y @ images).add_(.5).floor_().clamp_(0, 255)
+    return images.to(torch.uint8)
+
+
+def make_grid(images, num_rows=1, offset_ratio=0.02) -> np.ndarray:
+    # tiles go into one white canvas of shape (rows, h + offset, cols, w + offset, c) with a single strided
+    # assignment per full row block, uint8 arrays are not copied on the way in
     if type(images) is list:
-        num_empty = len(images) % num_rows
-    elif images.ndim == 4:
-        num_empty = images.shape[0] % num_rows
-    else:
-        images = [images]
-        num_empty = 0
-
-    empty_images = np.ones(images[0].shape, dtype=np.uint8) * 255
-    images = [image.astype(np.uint8) for image in images] + [empty_images] * num_empty
-    # for image in images:
-    #     plt.imshow(image)
-    #     plt.show()
-    num_items = len(images)
-
-    h, w, c = images[0].shape
+        images = np.stack(images)
+    elif images.ndim == 3:
+        images = images[None]
+    images = images.astype(np.uint8, copy=False)
+    num_items, h, w, c = images.shape
     offset = int(h * offset_ratio)
-    num_cols = num_items // num_rows
-    image_ = np.ones((h * num_rows + offset * (num_rows - 1),
-                      w * num_cols + offset * (num_cols - 1), 3), dtype=np.uint8) * 255
-    for i in range(num_rows):
-        for j in range(num_cols):
-            image_[i * (h + offset): i * (h + offset) + h:, j * (w + offset): j * (w + offset) + w] = images[
-                i * num_cols + j]
-
-    pil_img = Image.fromarray(image_)
+    num_cols = (num_items + num_rows - 1) // num_rows
+    num_rows = (num_items + num_cols - 1) // num_cols
+    canvas = np.full((num_rows, h + offset, num_cols, w + offset, c), 255, dtype=np.uint8)
+    tiles = canvas[:, :h, :, :w].transpose(0, 2, 1, 3, 4)
+    num_full = num_items // num_cols
+    tiles[:num_full] = images[:num_full * num_cols].reshape(num_full, num_cols, h, w, c)
+    if num_full < num_rows:
+        tiles[num_full, :num_items - num_full * num_cols] = images[num_full * num_cols:]
+    canvas = canvas.reshape(num_rows * (h + offset), num_cols * (w + offset), c)
+    return canvas[:canvas.shape[0] - offset, :canvas.shape[1] - offset]
+
+
+def view_images(images, num_rows=1, offset_ratio=0.02, title="", sink: Optional[io_utils.ImageSink] = None):
+    image_ = make_grid(images, num_rows, offset_ratio)
     if title == "":
         title = "a"
-    pil_img.save(f"/cnvrg/{title}.jpg")
+    # written in the background, see io_utils.ImageSink
+    (sink or io_utils.default_sink()).save(image_, io_utils.output_path(f"{title}.jpg"))
     # display(pil_img)
     # plt.imshow(pil_img)
     # plt.title(title)
@@ -107,6 +146,14 @@ def init_latent(latent, model, height, width, generator, batch_size):
     return latent, latents
 
 
+def set_prompts(controller, prompts: List[str]):
+    # records the prompts of the run on the controller, and their number as its batch_size unless it fixes its
+    # own (edits do, from their prompts)
+    controller.prompts = list(prompts)
+    if getattr(controller, "infer_batch_size", False) or getattr(controller, "batch_size", None) is None:
+        controller.batch_size = len(prompts)
+
+
 @torch.no_grad()
 def text2image_ldm(
         model,
@@ -120,6 +167,7 @@ def text2image_ldm(
     register_attention_control(model, controller)
     height = width = 256
     batch_size = len(prompt)
+    set_prompts(controller, prompt)
 
     uncond_input = model.tokenizer([""] * batch_size, padding="max_length", max_length=77, return_tensors="pt")
     uncond_embeddings = model.bert(uncond_input.input_ids.to(model.device))[0]
@@ -138,6 +186,83 @@ def text2image_ldm(
     return image, latent
 
 
+class EmbeddingCache:
+    # text encoder outputs per prompt, in memory and optionally on disk under cache_dir.
+    # the returned tensors are shared, don't modify them in place
+
+    @staticmethod
+    def model_key(model):
+        tokenizer = model.tokenizer
+        model_id = getattr(model.text_encoder.config, "_name_or_path", "")
+        return f"{model_id}|{type(tokenizer).__name__}|{len(tokenizer)}|{tokenizer.model_max_length}"
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".pt")
+
+    def load(self, key: str, model):
+        if self.cache_dir is None:
+            return None
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            return torch.load(path, map_location=model.device).to(model.text_encoder.dtype)
+        except OSError:
+            return None
+        except (RuntimeError, EOFError, ValueError, AttributeError, pickle.UnpicklingError):
+            # truncated or not an embedding, dropped so it is encoded and saved again
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+    def save(self, key: str, embedding: torch.Tensor):
+        if self.cache_dir is None:
+            return
+        embedding = embedding.cpu()
+        io_utils.atomic_write(self.path(key), lambda tmp_path: torch.save(embedding, tmp_path))
+
+    @torch.no_grad()
+    def get(self, model, prompts: List[str]) -> torch.Tensor:
+        model_key = self.model_key(model)
+        memory_key = f"{model_key}|{model.device}|{model.text_encoder.dtype}"
+        embeddings = {prompt: self.embeddings.get((memory_key, prompt)) for prompt in prompts}
+        for prompt in [prompt for prompt, embedding in embeddings.items() if embedding is None]:
+            embeddings[prompt] = self.load(f"{model_key}|{prompt}", model)
+        missing = [prompt for prompt, embedding in embeddings.items() if embedding is None]
+        if len(missing) > 0:
+            text_input = model.tokenizer(
+                missing,
+                padding="max_length",
+                max_length=model.tokenizer.model_max_length,
+                truncation=True,
+                return_tensors="pt",
+            )
+            text_embeddings = model.text_encoder(text_input.input_ids.to(model.device))[0]
+            for prompt, embedding in zip(missing, text_embeddings.split(1)):
+                embeddings[prompt] = embedding
+                self.save(f"{model_key}|{prompt}", embedding)
+        for prompt, embedding in embeddings.items():
+            self.embeddings.put((memory_key, prompt), embedding)
+        return torch.cat([embeddings[prompt] for prompt in prompts])
+
+    def get_uncond(self, model, batch_size: int) -> torch.Tensor:
+        # a single "" embedding broadcast over the batch
+        uncond_embeddings = self.get(model, [""])
+        return uncond_embeddings.expand(batch_size, *uncond_embeddings.shape[1:])
+
+    def clear(self):
+        self.embeddings.clear()
+
+    def __init__(self, max_size: int = 1024, cache_dir: Optional[str] = None):
+        self.embeddings = seq_aligner.LRUCache(max_size)
+        self.cache_dir = cache_dir
+
+
+embedding_cache = EmbeddingCache()
+
+
 @torch.no_grad()
 def text2image_ldm_stable(
         model,
@@ -152,20 +277,10 @@ def text2image_ldm_stable(
     register_attention_control(model, controller)
     height = width = 512
     batch_size = len(prompt)
+    set_prompts(controller, prompt)
 
-    text_input = model.tokenizer(
-        prompt,
-        padding="max_length",
-        max_length=model.tokenizer.model_max_length,
-        truncation=True,
-        return_tensors="pt",
-    )
-    text_embeddings = model.text_encoder(text_input.input_ids.to(model.device))[0]
-    max_length = text_input.input_ids.shape[-1]
-    uncond_input = model.tokenizer(
-        [""] * batch_size, padding="max_length", max_length=max_length, return_tensors="pt"
-    )
-    uncond_embeddings = model.text_encoder(uncond_input.input_ids.to(model.device))[0]
+    text_embeddings = embedding_cache.get(model, prompt)
+    uncond_embeddings = embedding_cache.get_uncond(model, batch_size)
 
     context = [uncond_embeddings, text_embeddings]
     if not low_resource:
@@ -186,11 +301,47 @@ def text2image_ldm_stable(
     return image, latent
 
 
-def register_attention_control(model, controller):
+class LayerSpec(NamedTuple):
+    # attention layers a controller wants to see: any of `places`, up to max_res x max_res pixels
+    # (None = any resolution), cross or self attention (None = both), during steps [start, end)
+    is_cross: Optional[bool] = None
+    places: Tuple[str, ...] = ("down", "mid", "up")
+    max_res: Optional[int] = None
+    steps: Tuple[int, int] = (0, sys.maxsize)
+
+    def matches_layer(self, is_cross: bool, place_in_unet: str, num_pixels: int):
+        return (self.is_cross is None or self.is_cross == is_cross) and place_in_unet in self.places and \
+            (self.max_res is None or num_pixels <= self.max_res ** 2)
+
+    def matches(self, is_cross: bool, place_in_unet: str, num_pixels: int, step: int):
+        return self.steps[0] <= step < self.steps[1] and self.matches_layer(is_cross, place_in_unet, num_pixels)
 
 
+_sdpa_accepts_scale = True
 
 
+def fused_attention(q, k, v, scale, attention_mask=None, chunk_size=1024):
+    # softmax(q k^T * scale) v without keeping the full b x i x j probabilities around
+    global _sdpa_accepts_scale
+    if hasattr(F, "scaled_dot_product_attention"):
+        if _sdpa_accepts_scale:
+            try:
+                return F.scaled_dot_product_attention(q, k, v, attn_mask=attention_mask, scale=scale)
+            except TypeError:
+                _sdpa_accepts_scale = False
+        q = q * (scale * q.shape[-1] ** .5)
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=attention_mask)
+    out = torch.empty(*q.shape[:-1], v.shape[-1], dtype=q.dtype, device=q.device)
+    for i in range(0, q.shape[1], chunk_size):
+        sim = torch.einsum("b i d, b j d -> b i j", q[:, i: i + chunk_size], k) * scale
+        if attention_mask is not None:
+            sim.masked_fill_(~attention_mask, -torch.finfo(sim.dtype).max)
+        out[:, i: i + chunk_size] = torch.einsum("b i j, b j d -> b i d", sim.softmax(dim=-1), v)
+    return out
+
+
+def register_attention_control(model, controller):
+
     def ca_forward(self, place_in_unet):
         to_out = self.to_out
         if type(to_out) is torch.nn.modules.container.ModuleList:
@@ -198,8 +349,6 @@ def register_attention_control(model, controller):
         else:
             to_out = self.to_out
 
-
-
         def forward(x, encoder_hidden_states=None, attention_mask=None):
 
             batch_size, sequence_length, dim = x.shape
@@ -213,21 +362,27 @@ def register_attention_control(model, controller):
             k = self.reshape_heads_to_batch_dim(k)
             v = self.reshape_heads_to_batch_dim(v)
 
-            sim = torch.einsum("b i d, b j d -> b i j", q, k) * self.scale
-
             if attention_mask is not None:
                 attention_mask = attention_mask.reshape(batch_size, -1)
-                max_neg_value = -torch.finfo(sim.dtype).max
                 attention_mask = attention_mask[:, None, :].repeat(h, 1, 1)
-                sim.masked_fill_(~attention_mask, max_neg_value)
 
-            # attention, what we cannot get enough of
-            attn = sim.softmax(dim=-1)
-            attn = controller(attn, is_cross, place_in_unet)
+            if controller.needs_attention(is_cross, place_in_unet, sequence_length):
+                sim = torch.einsum("b i d, b j d -> b i j", q, k) * self.scale
 
-            out = torch.einsum("b i j, b j d -> b i d", attn, v)
-            out = self.reshape_batch_dim_to_heads(out)
+                if attention_mask is not None:
+                    max_neg_value = -torch.finfo(sim.dtype).max
+                    sim.masked_fill_(~attention_mask, max_neg_value)
+
+                # attention, what we cannot get enough of
+                attn = sim.softmax(dim=-1)
+                attn = controller(attn, is_cross, place_in_unet)
 
+                out = torch.einsum("b i j, b j d -> b i d", attn, v)
+            else:
+                # the controller never looks at this layer, skip materialising the probabilities
+                out = fused_attention(q, k, v, self.scale, attention_mask)
+                controller.end_layer()
+            out = self.reshape_batch_dim_to_heads(out)
 
             return to_out(out)
 
@@ -238,15 +393,29 @@ def register_attention_control(model, controller):
         def __call__(self, *args):
             return args[0]
 
+        def attention_specs(self):
+            return []
+
+        def needs_attention(self, is_cross: bool, place_in_unet: str, num_pixels: int):
+            return False
+
+        def end_layer(self):
+            return
+
         def __init__(self):
             self.num_att_layers = 0
 
     if controller is None:
         controller = DummyController()
+    # a controller that declares no layers gets the unmodified UNet
+    hook_layers = len(controller.attention_specs()) > 0
 
     def register_recr(net_, count, place_in_unet):
         if net_.__class__.__name__ == 'CrossAttention':
-            net_.forward = ca_forward(net_, place_in_unet)
+            if hook_layers:
+                net_.forward = ca_forward(net_, place_in_unet)
+            else:
+                net_.__dict__.pop("forward", None)
             return count + 1
         elif hasattr(net_, 'children'):
             for net__ in net_.children():
@@ -267,56 +436,34 @@ def register_attention_control(model, controller):
 
 
 def get_word_inds(text: str, word_place: int, tokenizer):
-    split_text = text.split(" ")
-    if type(word_place) is str:
-        word_place = [i for i, word in enumerate(split_text) if word_place == word]
-    elif type(word_place) is int:
-        word_place = [word_place]
-    out = []
-    if len(word_place) > 0:
-        words_encode = [tokenizer.decode([item]).strip("#") for item in tokenizer.encode(text)][1:-1]
-        cur_len, ptr = 0, 0
-
-        for i in range(len(words_encode)):
-            cur_len += len(words_encode[i])
-            if ptr in word_place:
-                out.append(i + 1)
-            if cur_len >= len(split_text[ptr]):
-                ptr += 1
-                cur_len = 0
-    return np.array(out)
-
-
-
-def update_alpha_time_word(alpha, bounds: Union[float, Tuple[float, float]], prompt_ind: int,
-                           word_inds: Optional[torch.Tensor] = None):
-    if type(bounds) is float:
-        bounds = 0, bounds
-    start, end = int(bounds[0] * alpha.shape[0]), int(bounds[1] * alpha.shape[0])
-    if word_inds is None:
-        word_inds = torch.arange(alpha.shape[2])
-    alpha[: start, prompt_ind, word_inds] = 0
-    alpha[start: end, prompt_ind, word_inds] = 1
-    alpha[end:, prompt_ind, word_inds] = 0
-    return alpha
+    return seq_aligner.get_word_inds(text, word_place, tokenizer)
 
 
 def get_time_words_attention_alpha(prompts, num_steps,
                                    cross_replace_steps: Union[float, Dict[str, Tuple[float, float]]],
                                    tokenizer, max_num_words=77):
+    # every (edited prompt, token) gets a [start, end) step window, the default one or that of the last word key
+    # it belongs to, and the whole schedule is one comparison against the step numbers
     if type(cross_replace_steps) is not dict:
         cross_replace_steps = {"default_": cross_replace_steps}
-    if "default_" not in cross_replace_steps:
-        cross_replace_steps["default_"] = (0., 1.)
-    alpha_time_words = torch.zeros(num_steps + 1, len(prompts) - 1, max_num_words)
-    for i in range(len(prompts) - 1):
-        alpha_time_words = update_alpha_time_word(alpha_time_words, cross_replace_steps["default_"],
-                                                  i)
+    cross_replace_steps = {"default_": (0., 1.), **cross_replace_steps}
+
+    def step_bounds(bounds):
+        if type(bounds) is float:
+            bounds = 0, bounds
+        return int(bounds[0] * (num_steps + 1)), int(bounds[1] * (num_steps + 1))
+
+    start, end = step_bounds(cross_replace_steps["default_"])
+    starts = torch.full((len(prompts) - 1, max_num_words), start)
+    ends = torch.full((len(prompts) - 1, max_num_words), end)
     for key, item in cross_replace_steps.items():
         if key != "default_":
-            inds = [get_word_inds(prompts[i], key, tokenizer) for i in range(1, len(prompts))]
-            for i, ind in enumerate(inds):
-                if len(ind) > 0:
-                    alpha_time_words = update_alpha_time_word(alpha_time_words, item, i, ind)
+            start, end = step_bounds(item)
+            for i in range(1, len(prompts)):
+                ind = torch.as_tensor(get_word_inds(prompts[i], key, tokenizer), dtype=torch.long)
+                starts[i - 1, ind] = start
+                ends[i - 1, ind] = end
+    steps = torch.arange(num_steps + 1).reshape(-1, 1, 1)
+    alpha_time_words = ((steps >= starts) & (steps < ends)).float()
     alpha_time_words = alpha_time_words.reshape(num_steps + 1, len(prompts) - 1, 1, 1, max_num_words)
     return alpha_time_words
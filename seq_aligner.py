@@ -11,10 +11,40 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from collections import OrderedDict
+from typing import Optional, Tuple, List, Sequence
 import torch
 import numpy as np
 
 
+class LRUCache:
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            return default
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def __init__(self, max_size: int = 1024):
+        self.items = OrderedDict()
+        self.max_size = max_size
+
+
 class ScoreParams:
 
     def __init__(self, gap, match, mismatch):
@@ -58,7 +88,43 @@ def get_traceback_matrix(size_x, size_y):
     return matrix
 
 
+def global_align_batch(x, ys, score):
+    # aligns x against every sequence of ys at once, returns (len(ys), len(x) + 1, max_len_y + 1) matrices.
+    # wavefront over anti-diagonals: the cells with i + j = d only depend on the two previous diagonals,
+    # skewed[:, d, i] holds matrix[:, i, d - i] so every diagonal is a contiguous slice. The cells past the
+    # end of a shorter y never feed back into its own cells
+    size_x, size_y, batch = len(x), max([len(y) for y in ys], default=0), len(ys)
+    cost = np.full((batch, size_x, size_y), score.mismatch, dtype=np.int32)
+    for k, y in enumerate(ys):
+        cost[k, :, :len(y)] = np.where(np.asarray(x)[:, None] != np.asarray(y)[None, :], score.mismatch,
+                                       score.match)
+    rows, cols = np.indices((size_x, size_y))
+    cost_skewed = np.zeros((batch, size_x + size_y + 1, size_x + 1), dtype=np.int32)
+    cost_skewed[:, rows + cols, rows] = cost
+    skewed = np.zeros((batch, size_x + size_y + 1, size_x + 1), dtype=np.int32)
+    skewed[:, np.arange(size_y + 1), 0] = np.arange(size_y + 1) * score.gap
+    skewed[:, np.arange(size_x + 1), np.arange(size_x + 1)] = np.arange(size_x + 1) * score.gap
+    for d in range(2, size_x + size_y + 1):
+        start, end = max(1, d - size_y), min(size_x, d - 1) + 1
+        best = np.maximum(skewed[:, d - 1, start: end], skewed[:, d - 1, start - 1: end - 1]) + score.gap
+        np.maximum(best, skewed[:, d - 2, start - 1: end - 1] + cost_skewed[:, d - 2, start - 1: end - 1],
+                   out=skewed[:, d, start: end])
+    matrix = np.repeat(get_matrix(size_x, size_y, score.gap)[None], batch, axis=0)
+    matrix[:, 1:, 1:] = skewed[:, rows + cols + 2, rows + 1]
+    trace_back = np.repeat(get_traceback_matrix(size_x, size_y)[None], batch, axis=0)
+    left = matrix[:, 1:, :-1] + score.gap
+    up = matrix[:, :-1, 1:] + score.gap
+    trace_back[:, 1:, 1:] = np.where(matrix[:, 1:, 1:] == left, 1, np.where(matrix[:, 1:, 1:] == up, 2, 3))
+    return matrix, trace_back
+
+
 def global_align(x, y, score):
+    matrix, trace_back = global_align_batch(x, [y], score)
+    return matrix[0], trace_back[0]
+
+
+def global_align_loop(x, y, score):
+    # cell by cell reference of global_align, used by benchmarks/bench_seq_aligner.py
     matrix = get_matrix(len(x), len(y), score.gap)
     trace_back = get_traceback_matrix(len(x), len(y))
     for i in range(1, len(x) + 1):
@@ -104,49 +170,116 @@ def get_aligned_sequences(x, y, trace_back):
     return x_seq, y_seq, torch.tensor(mapper_y_to_x, dtype=torch.int64)
 
 
-def get_mapper(x: str, y: str, tokenizer, max_len=77):
-    x_seq = tokenizer.encode(x)
-    y_seq = tokenizer.encode(y)
-    score = ScoreParams(0, 1, -1)
-    matrix, trace_back = global_align(x_seq, y_seq, score)
-    mapper_base = get_aligned_sequences(x_seq, y_seq, trace_back)[-1]
+alignment_cache = LRUCache(1024)
+
+
+def align_token_ids_batch(x_seq: Tuple[int, ...], y_seqs: Sequence[Tuple[int, ...]]) -> List[torch.Tensor]:
+    # y -> x token mappers, pairs missing from the cache are aligned together in one pass.
+    # the mappers are shared between calls, don't modify them in place
+    mappers = {y_seq: alignment_cache.get((x_seq, y_seq)) for y_seq in y_seqs}
+    missing = [y_seq for y_seq, mapper_base in mappers.items() if mapper_base is None]
+    if len(missing) > 0:
+        score = ScoreParams(0, 1, -1)
+        matrix, trace_back = global_align_batch(x_seq, missing, score)
+        for k, y_seq in enumerate(missing):
+            mappers[y_seq] = get_aligned_sequences(x_seq, y_seq, trace_back[k, :, :len(y_seq) + 1])[-1]
+            alignment_cache.put((x_seq, y_seq), mappers[y_seq])
+    return [mappers[y_seq] for y_seq in y_seqs]
+
+
+def align_token_ids(x_seq: Tuple[int, ...], y_seq: Tuple[int, ...]) -> torch.Tensor:
+    return align_token_ids_batch(x_seq, [y_seq])[0]
+
+
+def mapper_from_alignment(mapper_base: torch.Tensor, len_y: int, max_len=77):
     alphas = torch.ones(max_len)
     alphas[: mapper_base.shape[0]] = mapper_base[:, 1].ne(-1).float()
     mapper = torch.zeros(max_len, dtype=torch.int64)
     mapper[:mapper_base.shape[0]] = mapper_base[:, 1]
-    mapper[mapper_base.shape[0]:] = len(y_seq) + torch.arange(max_len - len(y_seq))
+    mapper[mapper_base.shape[0]:] = len_y + torch.arange(max_len - len_y)
     return mapper, alphas
 
 
-def get_refinement_mapper(prompts, tokenizer, max_len=77):
-    x_seq = prompts[0]
-    mappers, alphas = [], []
-    for i in range(1, len(prompts)):
-        mapper, alpha = get_mapper(x_seq, prompts[i], tokenizer, max_len)
-        mappers.append(mapper)
-        alphas.append(alpha)
-    return torch.stack(mappers), torch.stack(alphas)
+def get_mapper(x: str, y: str, tokenizer, max_len=77):
+    x_seq, y_seq = [prompt.token_ids for prompt in analyze_prompts([x, y], tokenizer)]
+    mapper_base = align_token_ids(x_seq, y_seq)
+    return mapper_from_alignment(mapper_base, len(y_seq), max_len)
+
+
+def get_refinement_mapper(prompts, tokenizer, max_len=77, device=None):
+    # one source against all the edits: the targets are tokenized in a single call and aligned together
+    x_seq, *y_seqs = [prompt.token_ids for prompt in analyze_prompts(prompts, tokenizer)]
+    mappers_base = align_token_ids_batch(x_seq, y_seqs)
+    mappers, alphas = zip(*[mapper_from_alignment(mapper_base, len(y_seq), max_len)
+                            for y_seq, mapper_base in zip(y_seqs, mappers_base)])
+    return torch.stack(mappers).to(device), torch.stack(alphas).to(device)
+
+
+class PromptTokens:
+
+    @property
+    def pieces(self) -> List[str]:
+        # decoded tokens without the start and end tokens
+        if self._pieces is None:
+            self._pieces = [self.tokenizer.decode([item]).strip("#") for item in self.token_ids][1:-1]
+        return self._pieces
+
+    @property
+    def word_to_tokens(self) -> List[List[int]]:
+        # token indices of every space separated word
+        if self._word_to_tokens is None:
+            word_to_tokens = [[] for _ in self.words]
+            cur_len, ptr = 0, 0
+            for i in range(len(self.pieces)):
+                if ptr == len(self.words):
+                    break
+                cur_len += len(self.pieces[i])
+                word_to_tokens[ptr].append(i + 1)
+                if cur_len >= len(self.words[ptr]):
+                    ptr += 1
+                    cur_len = 0
+            self._word_to_tokens = word_to_tokens
+        return self._word_to_tokens
+
+    def word_inds(self, word_place):
+        if type(word_place) is str:
+            word_place = [i for i, word in enumerate(self.words) if word_place == word]
+        elif type(word_place) is int:
+            word_place = [word_place]
+        out = [ind for place in sorted(set(word_place)) if 0 <= place < len(self.words)
+               for ind in self.word_to_tokens[place]]
+        return np.array(out)
+
+    def __init__(self, text: str, tokenizer, token_ids: Optional[Sequence[int]] = None):
+        self.text = text
+        self.tokenizer = tokenizer
+        self.words = text.split(" ")
+        self.token_ids = tuple(tokenizer.encode(text) if token_ids is None else token_ids)
+        self._pieces = None
+        self._word_to_tokens = None
+
+
+prompt_cache = LRUCache(1024)
+
+
+def analyze_prompts(texts: Sequence[str], tokenizer) -> List[PromptTokens]:
+    # the prompts missing from the cache are tokenized in a single call
+    prompts = {text: prompt_cache.get((id(tokenizer), text)) for text in texts}
+    missing = [text for text, prompt in prompts.items() if prompt is None]
+    if len(missing) > 0:
+        for text, input_ids in zip(missing, tokenizer(missing).input_ids):
+            prompts[text] = PromptTokens(text, tokenizer, input_ids)
+            # the cached entry keeps the tokenizer alive, so its id is not reused
+            prompt_cache.put((id(tokenizer), text), prompts[text])
+    return [prompts[text] for text in texts]
+
+
+def analyze_prompt(text: str, tokenizer) -> PromptTokens:
+    return analyze_prompts([text], tokenizer)[0]
 
 
 def get_word_inds(text: str, word_place: int, tokenizer):
-    split_text = text.split(" ")
-    if type(word_place) is str:
-        word_place = [i for i, word in enumerate(split_text) if word_place == word]
-    elif type(word_place) is int:
-        word_place = [word_place]
-    out = []
-    if len(word_place) > 0:
-        words_encode = [tokenizer.decode([item]).strip("#") for item in tokenizer.encode(text)][1:-1]
-        cur_len, ptr = 0, 0
-
-        for i in range(len(words_encode)):
-            cur_len += len(words_encode[i])
-            if ptr in word_place:
-                out.append(i + 1)
-            if cur_len >= len(split_text[ptr]):
-                ptr += 1
-                cur_len = 0
-    return np.array(out)
+    return analyze_prompt(text, tokenizer).word_inds(word_place)
 
 
 def get_replacement_mapper_(x: str, y: str, tokenizer, max_len=77):
@@ -186,6 +319,15 @@ def get_replacement_mapper_(x: str, y: str, tokenizer, max_len=77):
 
 
 
+def get_compact_mapper(mapper: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    # (batch, source, target) mapper -> (batch, target, k) source indices and weights per target token, k is
+    # the most sources mapped into one target. unused slots get weight 0
+    columns = mapper.transpose(1, 2)
+    k = max(int(columns.ne(0).sum(-1).max()), 1)
+    weights, inds = columns.topk(k, dim=-1)
+    return inds, weights
+
+
 def get_replacement_mapper(prompts, tokenizer, max_len=77):
     x_seq = prompts[0]
     mappers = []